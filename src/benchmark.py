@@ -0,0 +1,48 @@
+import json
+import time
+import random
+import argparse
+import msgpack
+
+# Compares the cost of decoding `InputVolumeMeters` events per transport. Run with `python benchmark.py`.
+
+INPUT_COUNT = 16
+ITERATIONS = 20000
+
+def build_meter_event(inputCount: int) -> dict:
+    inputs = []
+    for i in range(inputCount):
+        # Stereo input, each channel being [magnitude, peak, input peak]
+        levels = [[random.random(), random.random(), random.random()] for channel in range(2)]
+        inputs.append({'inputName': 'Input {}'.format(i), 'inputUuid': '{:08x}-0000-4000-8000-{:012x}'.format(i, i), 'inputLevelsMul': levels})
+    return {'op': 5, 'd': {'eventType': 'InputVolumeMeters', 'eventIntent': 1 << 16, 'eventData': {'inputs': inputs}}}
+
+def run(name: str, func, message, iterations: int):
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(message)
+    elapsed = time.perf_counter() - start
+    print('{:40} {:8.2f} us/event | {:6} B/event'.format(name, elapsed / iterations * 1000000, len(message)))
+
+def decode_simpleobsws(message):
+    # simpleobsws formats each received message for its debug log, whether or not that is enabled
+    payload = msgpack.unpackb(message)
+    'Received message:\n{}'.format(json.dumps(payload, indent = 2))
+    return payload
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--inputs', type = int, default = INPUT_COUNT, help = 'Number of inputs in each meter event. Default: {}'.format(INPUT_COUNT))
+    parser.add_argument('-n', '--iterations', type = int, default = ITERATIONS, help = 'Number of events to decode per transport. Default: {}'.format(ITERATIONS))
+    args = parser.parse_args()
+
+    event = build_meter_event(args.inputs)
+    jsonMessage = json.dumps(event)
+    msgpackMessage = msgpack.packb(event)
+    print('InputVolumeMeters with {} inputs, {} iterations:'.format(args.inputs, args.iterations))
+    run('JSON', json.loads, jsonMessage, args.iterations)
+    run('MessagePack', msgpack.unpackb, msgpackMessage, args.iterations)
+    run('MessagePack, simpleobsws receive loop', decode_simpleobsws, msgpackMessage, args.iterations)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import logging
+import threading
+import time
+import dataclasses
+from dataclasses import dataclass, field
+
+SYSEX_HEADER = [0xF0, 0x00, 0x00, 0x66, 0x15]
+SYSEX_LCD_TEXT = 0x12
+SYSEX_LCD_COLOR = 0x72
+LCD_LINE_LENGTH = 56 # 8 strips * 7 characters
+
+BUTTON_NOTE_OFFSETS = {
+    'rec': 0,
+    'solo': 8,
+    'mute': 16,
+    'select': 24,
+    'encoder': 32,
+    'touch': 104
+}
+LED_NAMES = ['rec', 'solo', 'mute', 'select']
+
+MESSAGE_CATEGORIES = ['lcd_text', 'lcd_color', 'led', 'encoder', 'fader', 'meter', 'other']
+
+@dataclass
+class StripPanel:
+    lcdColorIdx: int = 0
+    lcdText: list[str] = field(default_factory = lambda: ['       ', '       '])
+    encoder: int = 0
+    leds: dict[str, bool] = field(default_factory = lambda: {name: False for name in LED_NAMES})
+    faderPos: int = 0
+    meterLevel: int = 0
+
+@dataclass
+class CategoryStats:
+    messages: int = 0
+    bytes: int = 0
+    redundant: int = 0 # Messages which did not change the panel
+
+class VirtualMidiIn:
+    def __init__(self, surface, portName: str):
+        self.surface = surface
+        self.portName = portName
+        self.portOpen = False
+        self.callback = None
+        self.callbackData = None
+
+    def get_ports(self):
+        return [self.surface.get_port_name(self.portName)] if self.surface.connected else []
+
+    def get_port_name(self, idx: int):
+        return self.surface.get_port_name(self.portName)
+
+    def open_port(self, idx: int = 0):
+        self.portOpen = True
+
+    def close_port(self):
+        self.portOpen = False
+
+    def is_port_open(self):
+        return self.portOpen
+
+    def set_callback(self, callback, data = None):
+        self.callback = callback
+        self.callbackData = data
+
+    def cancel_callback(self):
+        self.callback = None
+        self.callbackData = None
+
+    def inject(self, msg, deltaTime: float = 0.0):
+        # Returns what the callback returned, e.g. the future of the handler it scheduled
+        if not self.callback or not self.portOpen or not self.surface.connected:
+            return None
+        return self.callback((list(msg), deltaTime), self.callbackData)
+
+class VirtualMidiOut:
+    def __init__(self, surface, portName: str):
+        self.surface = surface
+        self.portName = portName
+        self.portOpen = False
+
+    def get_ports(self):
+        return [self.surface.get_port_name(self.portName)] if self.surface.connected else []
+
+    def get_port_name(self, idx: int):
+        return self.surface.get_port_name(self.portName)
+
+    def open_port(self, idx: int = 0):
+        self.portOpen = True
+
+    def close_port(self):
+        self.portOpen = False
+
+    def is_port_open(self):
+        return self.portOpen
+
+    def send_message(self, msg):
+        if not self.surface.connected:
+            return # Lost on the way, like writes to an unplugged device
+        self.surface.on_message(msg)
+
+class VirtualSurface:
+    # Software X-Touch Extender. Decodes the bytes `midi.Device` sends into a panel model, and accounts for them per message category.
+    def __init__(self, portName: str, stripCount: int = 8):
+        self.input = VirtualMidiIn(self, portName)
+        self.output = VirtualMidiOut(self, portName)
+
+        self.lock = threading.Lock()
+        self.connected = True
+        self.plugCount = 0
+        self.strips = []
+        self.lcd = []
+        self.pendingClears = {} # LCD offset -> (contents before a clear that changed them, stats the clear was counted in)
+        self._reset_panel(stripCount)
+        self.stats = {}
+        self.statsStartTime = 0
+        self.reset_stats()
+
+    def _reset_panel(self, stripCount: int):
+        self.strips = [StripPanel() for i in range(stripCount)]
+        self.lcd = [' '] * (LCD_LINE_LENGTH * 2)
+        self.pendingClears = {}
+
+    def unplug(self):
+        # Simulates a USB disconnect. The ports disappear from the port list and writes are lost.
+        self.connected = False
+
+    def plug(self):
+        # Simulates the device coming back with a blank panel
+        with self.lock:
+            self._reset_panel(len(self.strips))
+            self.plugCount += 1
+        self.connected = True
+
+    def get_port_name(self, portName: str) -> str:
+        # Like ALSA, the device gets a new client number every time it is plugged in
+        return '{} {}:0'.format(portName, 20 + self.plugCount)
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {category: CategoryStats() for category in MESSAGE_CATEGORIES}
+            self.statsStartTime = time.monotonic()
+
+    def on_message(self, msg):
+        data = bytes(msg) # Also validates that every value is a byte, like rtmidi would
+        with self.lock:
+            category, changed = self._decode(data)
+            stats = self.stats[category]
+            stats.messages += 1
+            stats.bytes += len(data)
+            if not changed:
+                stats.redundant += 1
+
+    def _decode(self, data: bytes) -> tuple[str, bool]:
+        status = data[0]
+        if status == 0xF0:
+            if list(data[:5]) != SYSEX_HEADER or len(data) < 7:
+                return 'other', False
+            if data[5] == SYSEX_LCD_TEXT:
+                return 'lcd_text', self._write_lcd_text(data[6], data[7:-1])
+            if data[5] == SYSEX_LCD_COLOR:
+                changed = False
+                for i, colorIdx in enumerate(data[6:-1]):
+                    if i < len(self.strips) and self.strips[i].lcdColorIdx != colorIdx:
+                        self.strips[i].lcdColorIdx = colorIdx
+                        changed = True
+                return 'lcd_color', changed
+            return 'other', False
+        if status == 0x90 and len(data) >= 3:
+            group, num = divmod(data[1], 8)
+            if group >= len(LED_NAMES) or num >= len(self.strips):
+                return 'other', False
+            on = data[2] >= 64
+            leds = self.strips[num].leds
+            changed = leds[LED_NAMES[group]] != on
+            leds[LED_NAMES[group]] = on
+            return 'led', changed
+        if status == 0xB0 and len(data) >= 3:
+            num = data[1] - 48
+            if not (0 <= num < len(self.strips)):
+                return 'other', False
+            changed = self.strips[num].encoder != data[2]
+            self.strips[num].encoder = data[2]
+            return 'encoder', changed
+        if 0xE0 <= status <= 0xEF and len(data) >= 3:
+            num = status - 0xE0
+            if num >= len(self.strips):
+                return 'other', False
+            changed = self.strips[num].faderPos != data[2]
+            self.strips[num].faderPos = data[2]
+            return 'fader', changed
+        if status == 0xD0 and len(data) >= 2:
+            num, level = divmod(data[1], 16)
+            if num >= len(self.strips):
+                return 'other', False
+            changed = self.strips[num].meterLevel != level
+            self.strips[num].meterLevel = level
+            return 'meter', changed
+        return 'other', False
+
+    def _write_lcd_text(self, offset: int, chars: bytes) -> bool:
+        # Text is written as a clear followed by the text itself. When the pair leaves the LCD as it was, both are redundant.
+        pendingClear = self.pendingClears.pop(offset, None)
+        if chars and not any(chars):
+            before = self.lcd[offset:offset + len(chars)]
+            changed = self._write_lcd(offset, chars)
+            if changed:
+                self.pendingClears[offset] = (before, self.stats['lcd_text'])
+            return changed
+        changed = self._write_lcd(offset, chars)
+        if pendingClear and self.lcd[offset:offset + len(pendingClear[0])] == pendingClear[0]:
+            pendingClear[1].redundant += 1 # The clear, counted as a change when it came in
+            return False
+        return changed
+
+    def _write_lcd(self, offset: int, chars: bytes) -> bool:
+        changed = False
+        for i, char in enumerate(chars):
+            pos = offset + i
+            if pos >= len(self.lcd):
+                break
+            char = chr(char) if char else ' ' # The clear message writes NUL characters
+            if self.lcd[pos] != char:
+                self.lcd[pos] = char
+                changed = True
+        for num, strip in enumerate(self.strips):
+            strip.lcdText = [''.join(self.lcd[(7 * num) + (LCD_LINE_LENGTH * line):(7 * num) + (LCD_LINE_LENGTH * line) + 7]) for line in range(2)]
+        return changed
+
+    def get_stats(self) -> tuple[float, dict[str, CategoryStats]]:
+        # Returns the seconds elapsed since the last `reset_stats` and a copy of the per-category counters, including a `total` category
+        with self.lock:
+            elapsed = max(time.monotonic() - self.statsStartTime, 0.001)
+            ret = {}
+            total = CategoryStats()
+            for category, stats in self.stats.items():
+                ret[category] = dataclasses.replace(stats)
+                total.messages += stats.messages
+                total.bytes += stats.bytes
+                total.redundant += stats.redundant
+            ret['total'] = total
+            return elapsed, ret
+
+    def log_stats(self):
+        elapsed, stats = self.get_stats()
+        for category, stat in stats.items():
+            logging.info('  - {}: {} msg ({:.1f}/s) | {} B ({:.1f}/s) | {} redundant'.format(category, stat.messages, stat.messages / elapsed, stat.bytes, stat.bytes / elapsed, stat.redundant))
+
+    def dump(self) -> list[str]:
+        with self.lock:
+            lines = []
+            for num, strip in enumerate(self.strips):
+                leds = ''.join(name[0].upper() if strip.leds[name] else '-' for name in LED_NAMES)
+                lines.append('{} | {:7} | {:7} | color {} | leds {} | enc {:3} | fader {:3} | meter {:2}'.format(num, strip.lcdText[0], strip.lcdText[1], strip.lcdColorIdx, leds, strip.encoder, strip.faderPos, strip.meterLevel))
+            return lines
+
+    def press(self, num: int, button: str, down: bool = True):
+        self.input.inject([0x90, num + BUTTON_NOTE_OFFSETS[button], 127 if down else 0])
+
+    def click(self, num: int, button: str):
+        self.press(num, button, True)
+        self.press(num, button, False)
+
+    def move_fader(self, num: int, pos: int):
+        with self.lock:
+            self.strips[num].faderPos = pos # Moved by hand
+        self.input.inject([0xE0 + num, 0, pos])
+
+    def turn_encoder(self, num: int, ticks: int):
+        # Clockwise ticks are sent as 1, counter-clockwise as 65
+        for i in range(abs(ticks)):
+            self.input.inject([0xB0, num + 16, 1 if ticks > 0 else 65])
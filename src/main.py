@@ -3,13 +3,17 @@ import time
 import platform
 import asyncio
 import argparse
+import multiprocessing
 
 import obs as obs_lib
 import midi as midi_lib
+import recording
+import emulator
+import midiproc
 import utils
 
-logging.basicConfig(level = logging.DEBUG, filename = 'xtouch-extender-obs.log')
-logging.getLogger('simpleobsws').setLevel(logging.INFO)
+LOG_FILE_NAME = 'xtouch-extender-obs.log'
+LOG_LEVEL = 'DEBUG'
 
 CONFIG_FILE_NAME = 'xtouch-obs-config.json'
 
@@ -20,72 +24,108 @@ FADER_TIMEOUT = 0.3
 MIDI_DEVICE_SIGNATURE = 'X-Touch-Ext'
 MIDI_DEVICE_INDEX = 0
 MIDI_STRIP_COUNT = 8
+MIDI_WATCH_INTERVAL = 1.0
+SNAPSHOT_INTERVAL = 5.0 # Minimum time between config file writes for changed input state, so a crash leaves a recent warm start snapshot
+MIDI_PROCESS = False
+METERS = True
+
+RECORD_FILE_NAME = ''
+REPLAY_FILE_NAME = ''
+REPLAY_SPEED = 1.0
+EMULATE = False
+EMULATOR_STATS_INTERVAL = 10.0
 
 config = None
 obs = None
 midi = None
+recorder = None
 
-async def obs_volmeter_callback(eventData):
-    for input in eventData["inputs"]:
-        uuid = input['inputUuid']
-        strip = midi.stripInputUuids.get(uuid)
-        if not strip:
-            continue
-        strip.on_input_volmeter(input['inputLevelsMul'])
+async def obs_volmeter_callback(instance, eventData):
+    # Runs for every meter event (20 per second), so inputs not bound to a strip are skipped before anything else is looked at
+    strips = midi.stripInputsByInstance.get(instance)
+    if not strips:
+        return
+    for input in eventData['inputs']:
+        strip = strips.get(input['inputUuid'])
+        if strip:
+            strip.on_input_volmeter(input['inputLevelsMul'])
 
-async def obs_balance_callback(eventData):
+async def obs_balance_callback(instance, eventData):
     uuid = eventData['inputUuid']
-    strip = midi.stripInputUuids.get(uuid)
+    strip = midi.stripInputUuids.get((instance, uuid))
     if not strip:
         return
     await strip.on_input_balance_change(eventData)
 
-async def obs_track_callback(eventData):
+async def obs_track_callback(instance, eventData):
     uuid = eventData['inputUuid']
-    strip = midi.stripInputUuids.get(uuid)
+    strip = midi.stripInputUuids.get((instance, uuid))
     if not strip:
         return
     await strip.on_input_track_change(eventData)
 
-async def obs_monitor_callback(eventData):
+async def obs_monitor_callback(instance, eventData):
     uuid = eventData['inputUuid']
-    strip = midi.stripInputUuids.get(uuid)
+    strip = midi.stripInputUuids.get((instance, uuid))
     if not strip:
         return
     await strip.on_input_monitor_change(eventData)
 
-async def obs_mute_callback(eventData):
+async def obs_mute_callback(instance, eventData):
     uuid = eventData['inputUuid']
-    strip = midi.stripInputUuids.get(uuid)
+    strip = midi.stripInputUuids.get((instance, uuid))
     if not strip:
         return
     await strip.on_input_mute_change(eventData)
 
-async def obs_volume_callback(eventData):
+async def obs_volume_callback(instance, eventData):
     uuid = eventData['inputUuid']
-    strip = midi.stripInputUuids.get(uuid)
+    strip = midi.stripInputUuids.get((instance, uuid))
     if not strip:
         return
     await strip.on_input_volume_change(eventData)
 
-async def obs_input_name_changed_callback(eventData):
+async def obs_input_name_changed_callback(instance, eventData):
     uuid = eventData['inputUuid']
-    strip = midi.stripInputUuids.get(uuid)
+    strip = midi.stripInputUuids.get((instance, uuid))
     if not strip:
         return
     # Prior callbacks would have updated the input name in the object already
     await strip.on_input_name_change()
 
-async def obs_input_remove_callback(eventData):
+async def obs_input_remove_callback(instance, eventData):
     uuid = eventData['inputUuid']
-    strip = midi.stripInputUuids.get(uuid)
+    strip = midi.stripInputUuids.get((instance, uuid))
     if not strip:
         return
     await asyncio.to_thread(strip.reset)
 
+async def obs_scene_changed_callback(instance, eventData):
+    if instance != '': # Layouts follow the primary instance
+        return
+    await midi.switch_layout(eventData['sceneName'])
+
+async def obs_connection_callback(instance, connected):
+    if not connected:
+        await midi.set_instance_offline(instance)
+        return
+    await midi.restore_instance(instance)
+    if instance != '' or not config.sceneLayouts:
+        return
+    # The program scene may have changed while the connection was down
+    try:
+        sceneName = (await obs.get('').call('GetCurrentProgramScene')).get('currentProgramSceneName') or ''
+    except:
+        logging.exception('Failed to get the current program scene:\n')
+        return
+    await midi.switch_layout(sceneName)
+
 def on_midi_message(msg, loop):
+    # Returns the future of the scheduled handler (awaited by replays), or None
     if not msg:
-        return
+        return None
+    if recorder:
+        recorder.record_midi_in(msg[0])
 
     b1 = msg[0][0]
     b2 = msg[0][1]
@@ -99,7 +139,7 @@ def on_midi_message(msg, loop):
                     await strip.process_button(val)
                 except:
                     logging.exception('Exception:\n')
-            asyncio.run_coroutine_threadsafe(process([b2, b3]), loop)
+            return asyncio.run_coroutine_threadsafe(process([b2, b3]), loop)
         elif b1 == 176:
             strip = midi.strips[b2 % 8]
             async def process(val):
@@ -107,7 +147,7 @@ def on_midi_message(msg, loop):
                     await strip.process_encoder(val)
                 except:
                     logging.exception('Exception:\n')
-            asyncio.run_coroutine_threadsafe(process([b2, b3]), loop)
+            return asyncio.run_coroutine_threadsafe(process([b2, b3]), loop)
         else:
             strip = midi.strips[b1 - 224]
             async def process(val):
@@ -115,104 +155,254 @@ def on_midi_message(msg, loop):
                     await strip.process_fader(val)
                 except:
                     logging.exception('Exception:\n')
-            asyncio.run_coroutine_threadsafe(process([b1, b3]), loop)
+            return asyncio.run_coroutine_threadsafe(process([b1, b3]), loop)
     except:
         logging.exception('Exception when handling incoming MIDI message:\n')
+    return None
 
 async def main():
     global config
-    config = utils.Config()
-    if not config.load(CONFIG_FILE_NAME):
-        logging.warning('Config file `{}` not loaded. Using default config.')
-
     global midi
-    midi = midi_lib.Device(MIDI_DEVICE_SIGNATURE, MIDI_DEVICE_INDEX)
-    await midi.print_ports()
-    if not await midi.open_ports():
-        logging.critical('Failed to open MIDI ports!')
-        return
-
     global obs
-    obs = obs_lib.ObsStudio(OBS_WEBSOCKET_URL, OBS_WEBSOCKET_PASSWORD)
-    try:
-        if not await obs.startup():
-            logging.critical('Failed to connect or identify with OBS.')
+    global recorder
+
+    player = None
+    surface = None
+    midiProcess = None
+    if REPLAY_FILE_NAME or EMULATE:
+        surface = emulator.VirtualSurface(MIDI_DEVICE_SIGNATURE, MIDI_STRIP_COUNT)
+    if REPLAY_FILE_NAME:
+        player = recording.Player(REPLAY_FILE_NAME, REPLAY_SPEED)
+        if not player.load():
+            logging.critical('Failed to load trace file `{}`.'.format(REPLAY_FILE_NAME))
             return
-    except:
-        logging.exception('Failed to connect or identify with OBS:\n')
-        return
+        config = player.config
+    else:
+        config = utils.Config()
+        if not config.load(CONFIG_FILE_NAME):
+            logging.warning('Config file `{}` not loaded. Using default config.'.format(CONFIG_FILE_NAME))
+    if surface:
+        midi = midi_lib.Device(MIDI_DEVICE_SIGNATURE, 0, surface.input, surface.output)
+    elif MIDI_PROCESS:
+        midiProcess = midiproc.MidiProcess()
+        if not midiProcess.start():
+            logging.critical('Failed to start the MIDI I/O process.')
+            return
+        midi = midi_lib.Device(MIDI_DEVICE_SIGNATURE, MIDI_DEVICE_INDEX, midiProcess.input, midiProcess.output)
+    else:
+        midi = midi_lib.Device(MIDI_DEVICE_SIGNATURE, MIDI_DEVICE_INDEX)
+    midi.metersEnabled = METERS
+
+    if RECORD_FILE_NAME:
+        recorder = recording.Recorder(RECORD_FILE_NAME)
+        if not recorder.start():
+            logging.critical('Failed to start recording to `{}`.'.format(RECORD_FILE_NAME))
+            return
+        midi.output = recording.RecordingMidiOut(midi.output, recorder)
+        logging.info('Recording to trace file `{}`.'.format(RECORD_FILE_NAME))
+
+    obs = obs_lib.ObsPool()
+    if player:
+        player.add_stub_instances(obs)
+    else:
+        # Only instances with inputs in the layout shown first start with meter events, loading the live layout re-identifies as needed
+        stripConfigs = config.sceneLayouts.get(config.lastScene, config.strips)[:MIDI_STRIP_COUNT]
+        boundInstances = set(strip.obsInstance for strip in stripConfigs if strip.obsInputUuid) if METERS else set()
+        obs.add(obs_lib.ObsStudio(OBS_WEBSOCKET_URL, OBS_WEBSOCKET_PASSWORD, '', '' in boundInstances))
+        for obsInstance in config.obsInstances:
+            obs.add(obs_lib.ObsStudio(obsInstance.url, obsInstance.password, obsInstance.name, obsInstance.name in boundInstances))
+        # Last known input state, so the panel can be drawn before OBS is connected
+        obs.set_cached_inputs(config.inputSnapshot)
+    obs.set_connection_callback(obs_connection_callback)
     midi.set_obs(obs)
-    logging.info('Connected and identified with obs-websocket at URL: {}'.format(OBS_WEBSOCKET_URL))
-
-    obs.ws.register_event_callback(obs_volmeter_callback, "InputVolumeMeters")
-    obs.ws.register_event_callback(obs_balance_callback, "InputAudioBalanceChanged")
-    obs.ws.register_event_callback(obs_track_callback, "InputAudioTracksChanged")
-    obs.ws.register_event_callback(obs_monitor_callback, "InputAudioMonitorTypeChanged")
-    obs.ws.register_event_callback(obs_mute_callback, "InputMuteStateChanged")
-    obs.ws.register_event_callback(obs_volume_callback, "InputVolumeChanged")
-    obs.ws.register_event_callback(obs_input_name_changed_callback, "InputNameChanged")
-    obs.ws.register_event_callback(obs_input_remove_callback, "InputRemoved")
-
-    await midi.create_strips(MIDI_STRIP_COUNT)
-    await midi.load_strips(config)
-    if len(midi.strips) != len(config.strips):
-        oldConfigStrips = len(config.strips)
+
+    async def start_midi():
+        await midi.print_ports()
+        if not await midi.open_ports():
+            logging.critical('Failed to open MIDI ports!')
+            return False
+        await midi.create_strips(MIDI_STRIP_COUNT)
+        await midi.load_strips(config, config.lastScene)
+        logging.info('Rendered panel from cached state.')
+        return True
+
+    async def start_obs():
+        try:
+            if not await obs.startup():
+                logging.critical('Failed to connect or identify with OBS.')
+                return False
+        except:
+            logging.exception('Failed to connect or identify with OBS:\n')
+            return False
+        return True
+
+    midiStarted, obsStarted = await asyncio.gather(start_midi(), start_obs())
+    if not midiStarted or not obsStarted:
+        # Undo whatever half did start. The panel must not keep showing the cached state as if it were live.
+        if midiStarted:
+            await midi.clear_strips()
+            await midi.close_ports()
+        await obs.shutdown()
+        if midiProcess:
+            midiProcess.stop()
+        if recorder:
+            recorder.stop()
+        return
+
+    obs.register_event_callback(obs_volmeter_callback, "InputVolumeMeters")
+    obs.register_event_callback(obs_balance_callback, "InputAudioBalanceChanged")
+    obs.register_event_callback(obs_track_callback, "InputAudioTracksChanged")
+    obs.register_event_callback(obs_monitor_callback, "InputAudioMonitorTypeChanged")
+    obs.register_event_callback(obs_mute_callback, "InputMuteStateChanged")
+    obs.register_event_callback(obs_volume_callback, "InputVolumeChanged")
+    obs.register_event_callback(obs_input_name_changed_callback, "InputNameChanged")
+    obs.register_event_callback(obs_input_remove_callback, "InputRemoved")
+    obs.register_event_callback(obs_scene_changed_callback, "CurrentProgramSceneChanged")
+
+    sceneName = ''
+    if config.sceneLayouts:
+        try:
+            sceneName = (await obs.get('').call('GetCurrentProgramScene')).get('currentProgramSceneName') or ''
+        except:
+            logging.exception('Failed to get the current program scene:\n')
+
+    if recorder:
+        recorder.record_obs_inputs(obs.get_inputs())
+        # The layout the trace starts in, replays answer `GetCurrentProgramScene` with it
+        config.lastScene = sceneName if sceneName in config.sceneLayouts else ''
+        recorder.record_config(config)
+        obs.set_request_callback(recorder.record_obs_request)
+        obs.register_event_callback(recorder.on_obs_event)
+
+    # Rebind the strips to the live inputs. Only what differs from the cached state is sent to the device.
+    await midi.reload_strips(sceneName)
+    if not player and len(midi.strips) != len(midi.get_layout_config(midi.currentLayout)):
+        oldConfigStrips = len(midi.get_layout_config(midi.currentLayout))
         await midi.persist_strips(config)
         config.save(CONFIG_FILE_NAME)
-        logging.info('Updated config file from {} to {} strips.'.format(oldConfigStrips, len(config.strips)))
-    midi.input.set_callback(on_midi_message, asyncio.get_running_loop())
+        logging.info('Updated config file from {} to {} strips.'.format(oldConfigStrips, len(midi.strips)))
+    midi.set_input_callback(on_midi_message, asyncio.get_running_loop())
 
     logging.info('Finished starting up.')
 
+    playTask = None
+    watchTask = None
+    if player:
+        playTask = asyncio.create_task(player.play(midi.input, obs))
+    else:
+        watchTask = asyncio.create_task(midi.watch_ports(MIDI_WATCH_INTERVAL))
+
+    statsTime = time.monotonic()
+    snapshotTime = time.monotonic()
+    snapshotGeneration = (obs.get_state_generation(), midi.bindingGeneration)
+    savedConfig = config.to_dict()
     try:
-        while True:
+        while not playTask or not playTask.done():
+            if not player and time.monotonic() - snapshotTime >= SNAPSHOT_INTERVAL:
+                snapshotTime = time.monotonic()
+                generation = (obs.get_state_generation(), midi.bindingGeneration)
+                if generation != snapshotGeneration:
+                    snapshotGeneration = generation
+                    await midi.persist_strips(config)
+                    data = config.to_dict()
+                    if data != savedConfig and config.save(CONFIG_FILE_NAME):
+                        savedConfig = data
+            if EMULATE and time.monotonic() - statsTime >= EMULATOR_STATS_INTERVAL:
+                logging.info('Emulated surface MIDI output:')
+                surface.log_stats()
+                surface.reset_stats()
+                statsTime = time.monotonic()
+            if config.sceneLayouts:
+                midi.refresh_layout_frames()
             for strip in midi.strips:
                 if strip.state != strip.State.Active:
                     continue
                 if strip.stateData.fader_busy() == -1:
                     await asyncio.to_thread(strip.stateData._render_fader)
+            midi.update_readouts()
             await asyncio.sleep(0.05)
     except asyncio.exceptions.CancelledError:
         logging.info('Shutting down...')
+    if watchTask:
+        watchTask.cancel()
     try:
-        await midi.persist_strips(config)
-        if config.save(CONFIG_FILE_NAME):
-            logging.info('Config file `{}` saved.'.format(CONFIG_FILE_NAME))
+        if player:
+            if playTask.done() and playTask.exception():
+                logging.error('Replay failed: {}'.format(playTask.exception()))
+            player.log_summary(surface, obs)
         else:
-            logging.info('Failed to save config file: {}'.format(CONFIG_FILE_NAME))
+            await midi.persist_strips(config)
+            if config.save(CONFIG_FILE_NAME):
+                logging.info('Config file `{}` saved.'.format(CONFIG_FILE_NAME))
+            else:
+                logging.info('Failed to save config file: {}'.format(CONFIG_FILE_NAME))
 
         await obs.shutdown()
         await midi.clear_strips()
+        if midiProcess:
+            midiProcess.stop()
+        if recorder:
+            recorder.stop()
 
         logging.info('Finished shutting down.')
     except:
         logging.exception('Exception:\n')
 
 def process_args():
+    global LOG_FILE_NAME
+    global LOG_LEVEL
     global CONFIG_FILE_NAME
     global OBS_WEBSOCKET_URL
     global OBS_WEBSOCKET_PASSWORD
     global MIDI_DEVICE_SIGNATURE
     global MIDI_DEVICE_INDEX
     global MIDI_STRIP_COUNT
+    global RECORD_FILE_NAME
+    global REPLAY_FILE_NAME
+    global REPLAY_SPEED
+    global EMULATE
+    global MIDI_PROCESS
+    global METERS
 
     parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--log_level', type = str.upper, default = LOG_LEVEL, choices = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help = 'Log level. Default: {}'.format(LOG_LEVEL))
+    parser.add_argument('-L', '--log_file', type = str, default = LOG_FILE_NAME, help = 'Log file name. Default: {}'.format(LOG_FILE_NAME))
     parser.add_argument('-c', '--config_file', type = str, default = CONFIG_FILE_NAME, help = 'Config/state file name, used for persistence of configurations made via the X-Touch device. Default: {}'.format(CONFIG_FILE_NAME))
     parser.add_argument('-u', '--websocket_url', type = str, default = OBS_WEBSOCKET_URL, help = 'obs-websocket URL. Default: {}'.format(OBS_WEBSOCKET_URL))
     parser.add_argument('-p', '--websocket_password', type = str, default = '', help = 'obs-websocket Password. Default is none.')
     parser.add_argument('-s', '--midi_signature', type = str, default = MIDI_DEVICE_SIGNATURE, help = 'MIDI device signature - a string to look for in the device name. Default: {}'.format(MIDI_DEVICE_SIGNATURE))
     parser.add_argument('-d', '--midi_device', type = int, default = 0, help = 'MIDI device index to select out of the devices matching the signature. Default: 0')
     parser.add_argument('-S', '--midi_strip_count', type = int, default = MIDI_STRIP_COUNT, help = 'Number of strips that the device has. Default: {}'.format(MIDI_STRIP_COUNT))
+    parser.add_argument('-r', '--record', type = str, default = RECORD_FILE_NAME, help = 'Record incoming/outgoing MIDI and OBS traffic to this trace file.')
+    parser.add_argument('-R', '--replay', type = str, default = REPLAY_FILE_NAME, help = 'Replay a trace file against fake MIDI ports and a stub OBS instead of connecting to the device and OBS.')
+    parser.add_argument('-E', '--emulate', action = 'store_true', help = 'Use a software X-Touch Extender emulator instead of the MIDI device, logging its MIDI traffic periodically.')
+    parser.add_argument('-P', '--midi_process', action = 'store_true', help = 'Run MIDI I/O in a separate process, exchanging messages through shared memory.')
+    parser.add_argument('-M', '--no_meters', action = 'store_true', help = 'Do not subscribe to OBS volume meters, leaving the strip meters off.')
+    parser.add_argument('--replay_speed', type = float, default = REPLAY_SPEED, help = 'Replay speed multiplier. 0 replays as fast as possible. Default: {}'.format(REPLAY_SPEED))
 
     args = parser.parse_args()
+    LOG_FILE_NAME = args.log_file
+    LOG_LEVEL = args.log_level
     CONFIG_FILE_NAME = args.config_file
     OBS_WEBSOCKET_URL = args.websocket_url
     OBS_WEBSOCKET_PASSWORD = args.websocket_password
     MIDI_DEVICE_SIGNATURE = args.midi_signature
     MIDI_DEVICE_INDEX = args.midi_device
     MIDI_STRIP_COUNT = args.midi_strip_count
+    RECORD_FILE_NAME = args.record
+    REPLAY_FILE_NAME = args.replay
+    REPLAY_SPEED = args.replay_speed
+    EMULATE = args.emulate
+    MIDI_PROCESS = args.midi_process
+    METERS = not args.no_meters
 
 # todo implement RTP-MIDI (ethernet) protocol
 if __name__ == "__main__":
+    multiprocessing.freeze_support() # Needed by the MIDI I/O process in frozen builds
     process_args()
-    asyncio.run(main())
+    logListener = utils.setup_logging(getattr(logging, LOG_LEVEL), LOG_FILE_NAME)
+    logging.getLogger('simpleobsws').setLevel(logging.INFO)
+    try:
+        asyncio.run(main())
+    finally:
+        logListener.stop()
@@ -1,11 +1,16 @@
 import logging
 import asyncio
+import threading
 import time
 import copy
 import math
-import simpleobsws
-import rtmidi
+import dataclasses
 from enum import Enum
+from dataclasses import dataclass, field
+try:
+    import rtmidi
+except ImportError: # Fake ports (replay) work without rtmidi or a MIDI backend
+    rtmidi = None
 
 import obs
 import utils
@@ -27,21 +32,78 @@ MIDI_LED_MODES = [
     (81, 91)
 ]
 
+LCD_READOUT_INTERVAL = 0.1 # Minimum time between live value writes to one strip
+LCD_READOUT_HOLD = 1.5 # Time the live value stays after the last change, before the label comes back
+FADER_TOUCH_HOLD_MAX = 10.0 # A touch without moves for this long is taken as released, in case the release note was lost
+
 def my_map(x, in_min, in_max, out_min, out_max):
     return (x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min
 
+@dataclass
+class StripFrame:
+    # Everything shown on one strip. In a frame being applied `None` means "leave as is", in the panel shadow it means "unknown".
+    lcdColorIdx: int = None
+    lcdText: list = field(default_factory = lambda: [None, None])
+    encoder: int = None
+    rec: bool = None
+    solo: bool = None
+    mute: bool = None
+    select: bool = None
+    faderPos: int = None
+
+def build_idle_frame(lcdColorIdx: int = 7) -> StripFrame:
+    return StripFrame(lcdColorIdx, ['', ''], 0, False, False, False, False, 0)
+
+def build_input_frame(input: obs.Input, lcdColorIdx: int, leds: bool = True, lcd: bool = True, fader: bool = True, lcdLabel: str = '') -> StripFrame:
+    frame = StripFrame()
+    if leds:
+        frame.encoder = round(input.audioBalance * 10) + MIDI_LED_MODES[1][0]
+        frame.rec = input.audioTracks.get('2') or False
+        frame.solo = input.audioMonitorType == 'OBS_MONITORING_TYPE_MONITOR_AND_OUTPUT'
+        frame.mute = input.audioMuted
+        frame.select = False
+    if lcd:
+        frame.lcdColorIdx = lcdColorIdx
+        frame.lcdText = [input.name, lcdLabel]
+    if fader:
+        frame.faderPos = utils.x32_db_to_fader_val(input.audioVolumeDb)
+    return frame
+
 class Device:
-    def __init__(self, deviceSignature: str, deviceIndex: int = 0):
+    def __init__(self, deviceSignature: str, deviceIndex: int = 0, input = None, output = None):
         self.obs = None
         self.deviceSignature = deviceSignature
         self.deviceIndex = deviceIndex
 
-        self.input = rtmidi.MidiIn()
-        self.output = rtmidi.MidiOut()
+        # `input` and `output` default to rtmidi ports, but can be anything implementing the same methods
+        if (not input or not output) and not rtmidi:
+            raise Exception('rtmidi is not available.')
+        self.input = input or rtmidi.MidiIn()
+        self.output = output or rtmidi.MidiOut()
 
         self.lock = asyncio.Lock()
         self.strips = []
         self.stripInputUuids = {}
+        self.stripInputsByInstance = {} # Instance name -> {input UUID: strip}, lets the meter path skip whole events without building keys
+        self.metersEnabled = True
+        self.loadingStrips = False # Binding changes while (re)loading all strips are applied to the meter subscriptions once at the end
+        self.bindingGeneration = 0 # Incremented whenever a strip is bound or unbound
+        self.readoutWriteTimes = {} # Strip number -> time of the last live value write
+
+        self.portsOpen = False
+        self.portIdentity = None # (index, name) of the open input and output ports, a replug shows up as a different one
+        self.inputCallback = None
+        self.inputCallbackData = None
+
+        # Last state written to the device per strip, so that only changes are sent
+        self.panelLock = threading.Lock()
+        self.panel = []
+
+        # Strip layouts, keyed by program scene name. '' is the default layout (`Config.strips`).
+        self.config = None
+        self.currentLayout = ''
+        self.layoutFrames = {}
+        self.layoutFramesGeneration = -1
 
     async def print_ports(self):
         def do_print(midi):
@@ -55,6 +117,7 @@ class Device:
     async def open_ports(self):
         def do_open(self):
             ret = 0
+            identity = []
             foundIndex = 0
             for i, port in enumerate(self.input.get_ports()):
                 if self.deviceSignature in port:
@@ -66,6 +129,7 @@ class Device:
                         logging.error('Failed to open port {} at idx: {}'.format(self.input.get_port_name(i), i))
                         return False
                     ret += 1
+                    identity.append((i, port))
                     logging.info('Opened IN port at idx {}: {}'.format(i, self.input.get_port_name(i)))
                     break
             foundIndex = 0
@@ -79,33 +143,233 @@ class Device:
                         logging.error('Failed to open port {} at idx: {}'.format(self.output.get_port_name(i), i))
                         return False
                     ret += 1
+                    identity.append((i, port))
                     logging.info('Opened OUT port at idx {}: {}'.format(i, self.output.get_port_name(i)))
                     break
+            self.portIdentity = tuple(identity) if ret == 2 else None
             return ret == 2
-        return await asyncio.to_thread(do_open, self)
+        self.portsOpen = await asyncio.to_thread(do_open, self)
+        return self.portsOpen
+
+    async def close_ports(self):
+        def do_close(self):
+            self.portsOpen = False
+            self.portIdentity = None
+            if self.input.is_port_open():
+                self.input.cancel_callback()
+                self.input.close_port()
+            if self.output.is_port_open():
+                self.output.close_port()
+        await asyncio.to_thread(do_close, self)
+
+    def set_input_callback(self, callback, data = None):
+        # Kept so that it can be registered again when the ports are reopened
+        self.inputCallback = callback
+        self.inputCallbackData = data
+        self.input.set_callback(callback, data)
+
+    def _get_port_identity(self) -> tuple:
+        # Identity `open_ports` would record right now, None if the device is not there
+        identity = []
+        for midi in [self.input, self.output]:
+            ports = [(i, port) for i, port in enumerate(midi.get_ports()) if self.deviceSignature in port]
+            if len(ports) <= self.deviceIndex:
+                return None
+            identity.append(ports[self.deviceIndex])
+        return tuple(identity)
+
+    def _set_disconnected(self):
+        # The ports are closed by `watch_ports`, which reopens them once the device is back
+        if not self.portsOpen:
+            return
+        self.portsOpen = False
+        self.portIdentity = None
+        logging.warning('MIDI device `{}` disconnected. Waiting for it to come back...'.format(self.deviceSignature))
+
+    async def watch_ports(self, interval: float = 1.0):
+        # Detects the device being unplugged and plugged back in, then reopens the ports and redraws the panel.
+        # OBS state is untouched, strips keep their inputs. A replug shorter than `interval` shows up as a change of the matching ports,
+        # which usually come back with a different index or name (e.g. ALSA client number), or as a failed send.
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                identity = await asyncio.to_thread(self._get_port_identity)
+                if self.portsOpen and identity != self.portIdentity:
+                    self._set_disconnected()
+                if not self.portsOpen:
+                    await self.close_ports() # Also when only one of them was left open
+                    if identity == None:
+                        continue
+                    if not await self.open_ports():
+                        logging.error('Failed to reopen MIDI ports. Retrying...')
+                        continue
+                    if self.inputCallback:
+                        self.input.set_callback(self.inputCallback, self.inputCallbackData)
+                    await self.redraw()
+                    logging.info('MIDI device `{}` reconnected.'.format(self.deviceSignature))
+            except:
+                logging.exception('Exception while watching MIDI ports:\n')
+
+    async def redraw(self):
+        # The device may be in any state (e.g. after a power cycle), so write everything again
+        self.invalidate_panel()
+        async with self.lock:
+            for strip in self.strips:
+                if strip.state == strip.State.Active:
+                    strip.stateData.release_fader() # A release while the device was gone never arrived
+                await asyncio.to_thread(strip.stateData.render)
 
-    def set_obs(self, obs: obs.ObsStudio):
+    def set_obs(self, obs: obs.ObsPool):
         self.obs = obs
 
+    def bind_input(self, input: obs.Input, strip):
+        self.stripInputUuids[input.key()] = strip
+        self.stripInputsByInstance.setdefault(input.instance, {})[input.uuid] = strip
+        self.bindingGeneration += 1
+        self._update_meter_subscriptions()
+
+    def unbind_input(self, input: obs.Input):
+        if input.key() not in self.stripInputUuids:
+            return
+        del self.stripInputUuids[input.key()]
+        strips = self.stripInputsByInstance.get(input.instance)
+        if strips != None:
+            strips.pop(input.uuid, None)
+            if not strips:
+                del self.stripInputsByInstance[input.instance]
+        self.bindingGeneration += 1
+        self._update_meter_subscriptions()
+
+    def _update_meter_subscriptions(self):
+        # Only instances with at least one Active strip receive `InputVolumeMeters`
+        if not self.obs or self.loadingStrips:
+            return
+        self.obs.update_meter_subscriptions(set(self.stripInputsByInstance) if self.metersEnabled else set())
+
     async def create_strips(self, num: int):
         async with self.lock:
             self.strips = []
+            self.panel = [StripFrame() for i in range(num)]
             for i in range(num):
                 strip = await asyncio.to_thread(Strip, self, len(self.strips))
                 self.strips.append(strip)
 
-    async def load_strips(self, config: utils.Config):
+    async def load_strips(self, config: utils.Config, sceneName: str = ''):
         async with self.lock:
-            for i, strip in enumerate(self.strips):
-                if len(config.strips) <= i:
-                    break
-                await strip.load_config(config.strips[i])
+            self.config = config
+            self.currentLayout = sceneName if sceneName in config.sceneLayouts else ''
+            stripConfigs = self.get_layout_config(self.currentLayout)
+            # Cached state only, the subscriptions main.py started with stay until `reload_strips` binds the live inputs
+            self.loadingStrips = True
+            try:
+                for i, strip in enumerate(self.strips):
+                    if len(stripConfigs) <= i:
+                        break
+                    await strip.load_config(stripConfigs[i])
+            finally:
+                self.loadingStrips = False
 
     async def persist_strips(self, config: utils.Config):
         async with self.lock:
-            config.strips = []
+            stripConfigs = [strip.get_config() for strip in self.strips]
+            if self.currentLayout:
+                config.sceneLayouts[self.currentLayout] = stripConfigs
+            else:
+                config.strips = stripConfigs
+            config.lastScene = self.currentLayout
+            self.layoutFramesGeneration = -1 # Layout configs may have changed
+
+            # Snapshot the state of every input used by a layout, for rendering at the next startup before OBS is connected
+            oldSnapshot = {(x.get('instance', ''), x.get('uuid', '')): x for x in config.inputSnapshot}
+            snapshot = {}
+            for stripConfig in config.get_all_strips():
+                key = (stripConfig.obsInstance, stripConfig.obsInputUuid)
+                if not stripConfig.obsInputUuid or key in snapshot:
+                    continue
+                input = self.obs.get_input(*key) if self.obs else None
+                data = dataclasses.asdict(input) if input else oldSnapshot.get(key)
+                if data:
+                    snapshot[key] = data
+            config.inputSnapshot = list(snapshot.values())
+
+    def get_layout_config(self, layout: str) -> list[utils.StripConfig]:
+        if layout:
+            return self.config.sceneLayouts[layout]
+        return self.config.strips
+
+    def refresh_layout_frames(self):
+        # Keeps a frame for every layout pre-rendered from cached input state, so that switching needs no OBS requests.
+        if not self.config or not self.obs:
+            return
+        generation = self.obs.get_state_generation()
+        if generation == self.layoutFramesGeneration:
+            return
+        self.layoutFramesGeneration = generation
+        self.layoutFrames = {layout: self._build_layout_frames(layout) for layout in [''] + list(self.config.sceneLayouts.keys())}
+
+    def _build_layout_frames(self, layout: str) -> list[StripFrame]:
+        stripConfigs = self.get_layout_config(layout)
+        ret = []
+        for i in range(len(self.strips)):
+            stripConfig = stripConfigs[i] if i < len(stripConfigs) else utils.StripConfig()
+            input = self.obs.get_input(stripConfig.obsInstance, stripConfig.obsInputUuid) if stripConfig.obsInputUuid else None
+            ret.append(build_input_frame(input, stripConfig.lcdColorIdx, lcdLabel = stripConfig.lcdLabel) if input else build_idle_frame())
+        return ret
+
+    async def switch_layout(self, sceneName: str):
+        if not self.config:
+            return
+        layout = sceneName if sceneName in self.config.sceneLayouts else ''
+        if layout == self.currentLayout:
+            return
+        # Keep any changes made to the outgoing layout
+        await self.persist_strips(self.config)
+        await self.reload_strips(layout)
+        logging.info('Switched to strip layout for scene: {}'.format(layout or '(default)'))
+
+    async def reload_strips(self, sceneName: str):
+        # (Re)binds all strips to the layout for `sceneName`, sending only what differs from the current panel
+        if not self.config:
+            return
+        layout = sceneName if sceneName in self.config.sceneLayouts else ''
+        self.refresh_layout_frames()
+        async with self.lock:
+            self.currentLayout = layout
+            stripConfigs = self.get_layout_config(layout)
+            frames = list(self.layoutFrames.get(layout) or self._build_layout_frames(layout))
+            # Faders held or just moved by hand are left where they are, the new binding takes them over once released
+            busyFaders = {strip.num: strip.stateData for strip in self.strips if strip.state == strip.State.Active and strip.stateData.fader_busy() == 1}
+            self.loadingStrips = True
+            try:
+                for i, strip in enumerate(self.strips):
+                    await strip.load_config(stripConfigs[i] if i < len(stripConfigs) else utils.StripConfig(), False)
+            finally:
+                self.loadingStrips = False
+            for num, oldStateData in busyFaders.items():
+                if self.strips[num].state == Strip.State.Active:
+                    self.strips[num].stateData.take_fader(oldStateData)
+                frames[num] = dataclasses.replace(frames[num], faderPos = None) # The cached frame is shared, don't change it
+            await asyncio.to_thread(self.apply_frames, frames)
+            self._update_meter_subscriptions() # Also when no strip was bound, e.g. an empty layout
+
+    async def set_instance_offline(self, instance: str):
+        # Strips bound to inputs of `instance` go Idle, keeping their assignment until `restore_instance`
+        async with self.lock:
             for strip in self.strips:
-                config.strips.append(strip.get_config())
+                if strip.state == strip.State.Config and strip.oldState == strip.State.Active and strip.oldStateData.input.instance == instance:
+                    await asyncio.to_thread(strip.restore) # The selected input is gone, leave the menu
+                if strip.state != strip.State.Active or strip.stateData.input.instance != instance:
+                    continue
+                config = strip.get_config()
+                await asyncio.to_thread(strip.reset)
+                strip.offlineConfig = config
+
+    async def restore_instance(self, instance: str):
+        # Rebinds the strips that were kept for `instance` while it was offline, to its live inputs
+        async with self.lock:
+            for strip in self.strips:
+                if strip.state == strip.State.Idle and strip.offlineConfig and strip.offlineConfig.obsInstance == instance:
+                    await strip.load_config(strip.offlineConfig)
 
     async def clear_strips(self):
         async with self.lock:
@@ -113,14 +377,60 @@ class Device:
                 await asyncio.to_thread(strip.reset) # Sets the panel state back to default
             self.strips = []
 
-    def _set_lcd_color(self, num: int, colorIdx: int):
-        payload = [0xF0, 0x00, 0x00, 0x66, 0x15, 0x72]
-        for strip in self.strips:
-            payload.append(strip.stateData.lcdColorIdx if strip.state == Strip.State.Active else 7)
-        payload.append(0xF7)
-        payload[num + 6] = colorIdx
+    def invalidate_panel(self):
+        # Forces the next render to write everything, e.g. after the device was power cycled
+        with self.panelLock:
+            self.panel = [StripFrame() for i in range(len(self.panel))]
+
+    def on_fader_moved(self, num: int, pos: int):
+        # The motor fader is where the user left it, not where we last put it
+        self.panel[num].faderPos = pos
+
+    def apply_frame(self, num: int, frame: StripFrame):
+        self.apply_frames({num: frame})
+
+    def apply_frames(self, frames):
+        # `frames` is either a list of frames for all strips, or a {strip number: frame} dict
+        if type(frames) == list:
+            frames = dict(enumerate(frames))
+        self._set_lcd_colors({num: frame.lcdColorIdx for num, frame in frames.items() if frame.lcdColorIdx != None})
+        for num, frame in frames.items():
+            for line, text in enumerate(frame.lcdText):
+                if text != None:
+                    self._write_text(num, line, text)
+            if frame.encoder != None:
+                self._set_led_encoder(num, frame.encoder)
+            if frame.rec != None:
+                self._set_led_rec(num, frame.rec)
+            if frame.solo != None:
+                self._set_led_solo(num, frame.solo)
+            if frame.mute != None:
+                self._set_led_mute(num, frame.mute)
+            if frame.select != None:
+                self._set_led_select(num, frame.select)
+            if frame.faderPos != None:
+                self._set_fader_pos(num, frame.faderPos)
 
-        self.output.send_message(payload)
+    def _set_lcd_color(self, num: int, colorIdx: int):
+        self._set_lcd_colors({num: colorIdx})
+
+    def _set_lcd_colors(self, colors: dict):
+        # All strip colors are set with a single message
+        with self.panelLock:
+            changed = False
+            for num, colorIdx in colors.items():
+                if self.panel[num].lcdColorIdx != colorIdx:
+                    self.panel[num].lcdColorIdx = colorIdx
+                    changed = True
+            if not changed:
+                return
+            payload = [0xF0, 0x00, 0x00, 0x66, 0x15, 0x72]
+            for panel in self.panel:
+                if panel.lcdColorIdx == None:
+                    panel.lcdColorIdx = 7
+                payload.append(panel.lcdColorIdx)
+            payload.append(0xF7)
+            self._send(payload)
 
     def _write_text(self, num: int, line: int, text):
         if not (0 <= line <= 1):
@@ -128,11 +438,47 @@ class Device:
             return
 
         text = text[:7]
+        with self.panelLock:
+            if self.panel[num].lcdText[line] == text:
+                return
+            self.panel[num].lcdText[line] = text
+            self._send_text(num, line, text)
+
+    def update_readouts(self):
+        # Called every loop tick. Live values on the bottom LCD line are written at most every `LCD_READOUT_INTERVAL` per strip,
+        # intermediate values are dropped, and the label comes back `LCD_READOUT_HOLD` after the last change.
+        now = time.monotonic()
+        for strip in self.strips:
+            if strip.state != strip.State.Active or strip.stateData.readoutTime == None:
+                continue
+            stateData = strip.stateData
+            if now - stateData.readoutTime >= LCD_READOUT_HOLD:
+                stateData.readoutTime = None
+                stateData.readoutText = None
+            elif now - self.readoutWriteTimes.get(strip.num, 0.0) < LCD_READOUT_INTERVAL:
+                continue
+            if self._write_readout(strip.num, stateData.get_lcd_label()):
+                self.readoutWriteTimes[strip.num] = now
+
+    def _write_readout(self, num: int, text: str) -> bool:
+        # Unlike `_write_text`, one message overwriting all 7 characters, as this runs several times per second
+        text = text[:7]
+        with self.panelLock:
+            if self.panel[num].lcdText[1] == text:
+                return False
+            self.panel[num].lcdText[1] = text
+            payload = [0xF0, 0x00, 0x00, 0x66, 0x15, 0x12, 0x00 + (7 * num) + 56]
+            payload.extend([ord(char) for char in text.ljust(7)])
+            payload.append(0xF7)
+            self._send(payload)
+        return True
+
+    def _send_text(self, num: int, line: int, text):
         if not text:
             text = '       ' # In some cases, writing an empty string to the LCD will do nothing
 
         # Clear LCD text
-        self.output.send_message([
+        self._send([
             0xF0,  # MIDI System Exclusive Start
             0x00, 0x00, 0x66,  # Header of Mackie Control Protocol
             0x15,  # Device vendor ID
@@ -146,25 +492,41 @@ class Device:
         payload = [0xF0, 0x00, 0x00, 0x66, 0x15, 0x12, 0x00 + (7 * num) + (56 * line)]
         payload.extend([ord(char) for char in text])
         payload.append(0xF7)
-        self.output.send_message(payload)
+        self._send(payload)
+
+    def _send(self, msg):
+        if not self.portsOpen:
+            return # The panel is redrawn when the device comes back
+        try:
+            self.output.send_message(msg)
+        except:
+            logging.exception('Failed to send MIDI message:\n')
+            self._set_disconnected()
+
+    def _set_panel(self, num: int, name: str, value, msg):
+        with self.panelLock:
+            if getattr(self.panel[num], name) == value:
+                return
+            setattr(self.panel[num], name, value)
+            self._send(msg)
 
     def _set_led_encoder(self, num: int, val: int):
-        self.output.send_message([176, num + 48, val])
+        self._set_panel(num, 'encoder', val, [176, num + 48, val])
     def _set_led_rec(self, num: int, on: bool):
-        self.output.send_message([144, num, 127 if on else 0])
+        self._set_panel(num, 'rec', on, [144, num, 127 if on else 0])
     def _set_led_solo(self, num: int, on: bool):
-        self.output.send_message([144, num + 8, 127 if on else 0])
+        self._set_panel(num, 'solo', on, [144, num + 8, 127 if on else 0])
     def _set_led_mute(self, num: int, on: bool):
-        self.output.send_message([144, num + 16, 127 if on else 0])
+        self._set_panel(num, 'mute', on, [144, num + 16, 127 if on else 0])
     def _set_led_select(self, num: int, on: bool):
-        self.output.send_message([144, num + 24, 127 if on else 0])
+        self._set_panel(num, 'select', on, [144, num + 24, 127 if on else 0])
 
     def _set_fader_pos(self, num: int, pos: int):
-        self.output.send_message([num + 224, 1, pos])
+        self._set_panel(num, 'faderPos', pos, [num + 224, 1, pos])
 
     def _set_volmeter_db(self, num: int, db: float): # TODO: Use correct scale for this
-        midi_value = my_map(db, -60, 0, 0, 14)
-        self.output.send_message([208, (num * 16 + midi_value), 0])
+        midi_value = int(my_map(db, -60, 0, 0, 14))
+        self._send([208, (num * 16 + midi_value), 0])
 
 class Strip:
     class State(Enum):
@@ -178,20 +540,13 @@ class Strip:
             self.num = num
 
             self.lcdColorIdx = 7
+            self.lcdLabel = ''
 
         def render(self):
             if not self.midi:
                 return
-            logging.debug('Rendering State: Idle')
-            self.midi._set_lcd_color(self.num, self.lcdColorIdx)
-            self.midi._write_text(self.num, 0, '')
-            self.midi._write_text(self.num, 1, '')
-            self.midi._set_led_encoder(self.num, 0)
-            self.midi._set_led_rec(self.num, False)
-            self.midi._set_led_solo(self.num, False)
-            self.midi._set_led_mute(self.num, False)
-            self.midi._set_led_select(self.num, False)
-            self.midi._set_fader_pos(self.num, 0)
+            utils.log_sampled('render_idle', 1.0, logging.DEBUG, 'Rendering State: Idle')
+            self.midi.apply_frame(self.num, build_idle_frame(self.lcdColorIdx))
 
     class StateDataActive:
         def __init__(self, midi: Device, num: int):
@@ -200,39 +555,65 @@ class Strip:
 
             self.input = None
             self.lcdColorIdx = 7
+            self.lcdLabel = ''
+
+            # Live value shown instead of the label, written by `Device.update_readouts`
+            self.readoutText = None
+            self.readoutTime = None
 
             self.faderTime = None
+            # Touch-sense owns the fader while touched, `faderTime` is only a fallback for moves without touch notes
+            self.faderTouched = False
+            self.faderTouchTime = None # Time of the touch or the last move while touched
 
         def render(self):
             if not self.midi:
                 return
-            logging.debug('Rendering State: Active')
-            self._render_leds()
-            self._render_lcd()
-            self._render_fader()
+            utils.log_sampled('render_active', 1.0, logging.DEBUG, 'Rendering State: Active')
+            self.midi.apply_frame(self.num, build_input_frame(self.input, self.lcdColorIdx, fader = self.fader_busy() != 1, lcdLabel = self.get_lcd_label()))
 
         def _render_leds(self):
-            self.midi._set_led_encoder(self.num, round(self.input.audioBalance * 10) + MIDI_LED_MODES[1][0])
-            self.midi._set_led_rec(self.num, self.input.audioTracks.get('2') or False)
-            self.midi._set_led_solo(self.num, self.input.audioMonitorType == 'OBS_MONITORING_TYPE_MONITOR_AND_OUTPUT')
-            self.midi._set_led_mute(self.num, self.input.audioMuted)
-            self.midi._set_led_select(self.num, False)
+            self.midi.apply_frame(self.num, build_input_frame(self.input, self.lcdColorIdx, lcd = False, fader = False))
 
         def _render_lcd(self):
-            self.midi._set_lcd_color(self.num, self.lcdColorIdx)
-            self.midi._write_text(self.num, 0, self.input.name)
-            self.midi._write_text(self.num, 1, '')
+            self.midi.apply_frame(self.num, build_input_frame(self.input, self.lcdColorIdx, leds = False, fader = False, lcdLabel = self.get_lcd_label()))
 
         def _render_fader(self):
             if self.fader_busy() == 1:
                 return
-            pos = utils.x32_db_to_fader_val(self.input.audioVolumeDb)
-            self.midi._set_fader_pos(self.num, pos)
+            self.midi.apply_frame(self.num, build_input_frame(self.input, self.lcdColorIdx, leds = False, lcd = False))
 
         def set_input(self, input: obs.Input):
             self.input = input
 
+        def show_readout(self, text: str):
+            self.readoutText = text
+            self.readoutTime = time.monotonic()
+
+        def get_lcd_label(self) -> str:
+            return self.readoutText if self.readoutTime != None else self.lcdLabel
+
+        def touch_fader(self, touched: bool):
+            self.faderTouched = touched
+            self.faderTouchTime = time.monotonic() if touched else None
+
+        def release_fader(self):
+            self.faderTouched = False
+            self.faderTouchTime = None
+            self.faderTime = None
+
+        def take_fader(self, other):
+            # Keeps the hand in control of the fader when the strip is rebound while it is held or moving
+            self.faderTouched = other.faderTouched
+            self.faderTouchTime = other.faderTouchTime
+            self.faderTime = other.faderTime
+
         def fader_busy(self) -> int:
+            if self.faderTouched:
+                if time.monotonic() - self.faderTouchTime < FADER_TOUCH_HOLD_MAX:
+                    return 1
+                self.release_fader() # The release note was lost
+                return -1
             if not self.faderTime:
                 return 0
             if time.time_ns() - self.faderTime > 800000000:
@@ -252,7 +633,7 @@ class Strip:
                 ['CANCEL', True],
                 ['RESET', None]
             ]
-            for pair in midi.obs.inputNames:
+            for pair in midi.obs.get_input_names():
                 if not pair[1].supportsAudio:
                     continue
                 self.inputList.append(copy.copy(pair))
@@ -261,10 +642,12 @@ class Strip:
             # LCD Color Menu
             self.lcdColorIdx = 7
 
+            self.lcdLabel = '' # Not editable on the device, kept for the input selected next
+
         def render(self):
             if not self.midi:
                 return
-            logging.debug('Rendering State: Config')
+            utils.log_sampled('render_config', 1.0, logging.DEBUG, 'Rendering State: Config')
             self._render_leds()
             self._render_lcd()
 
@@ -314,54 +697,65 @@ class Strip:
         self.oldStateData = None
         self.enc_mode = 3
         self.enc_value = -81
+        self.offlineConfig = None # Config of an input on an OBS instance that is not connected, kept until the strip is reassigned
 
         self.stateData.render()
 
     def get_config(self) -> utils.StripConfig:
         if self.state == self.State.Idle:
-            return utils.StripConfig()
+            return self.offlineConfig or utils.StripConfig()
         if self.state == self.State.Active:
-            return utils.StripConfig(obsInputUuid = self.stateData.input.uuid, lcdColorIdx = self.stateData.lcdColorIdx)
+            return utils.StripConfig(obsInputUuid = self.stateData.input.uuid, obsInstance = self.stateData.input.instance, lcdColorIdx = self.stateData.lcdColorIdx, lcdLabel = self.stateData.lcdLabel)
         if self.state == self.State.Config:
             if self.oldState == self.State.Active:
-                return utils.StripConfig(obsInputUuid = self.oldStateData.input.uuid, lcdColorIdx = self.stateData.lcdColorIdx)
-        return utils.StripConfig()
+                return utils.StripConfig(obsInputUuid = self.oldStateData.input.uuid, obsInstance = self.oldStateData.input.instance, lcdColorIdx = self.stateData.lcdColorIdx, lcdLabel = self.stateData.lcdLabel)
+        return self.offlineConfig or utils.StripConfig()
 
-    async def load_config(self, config: utils.StripConfig):
+    async def load_config(self, config: utils.StripConfig, render: bool = True):
         if self.state != self.State.Idle:
-            await asyncio.to_thread(self.reset)
-        if config.obsInputUuid and config.obsInputUuid in self.midi.obs.inputs:
+            await asyncio.to_thread(self.reset, render)
+        self.offlineConfig = None
+        instance = self.midi.obs.get(config.obsInstance)
+        if config.obsInputUuid and (not instance or instance.offline):
+            # The instance is not connected. The strip stays Idle, but its assignment is saved back unchanged and restored on reconnect.
+            self.offlineConfig = config
+            logging.debug('Strip {} is bound to unavailable OBS instance `{}`.'.format(self.num, config.obsInstance))
+            return
+        input = self.midi.obs.get_input(config.obsInstance, config.obsInputUuid) if config.obsInputUuid else None
+        if input:
             self.state = self.State.Active
             self.stateData = self.StateDataActive(self.midi, self.num)
-            self.stateData.input = self.midi.obs.inputs[config.obsInputUuid]
+            self.stateData.input = input
             self.stateData.lcdColorIdx = config.lcdColorIdx
-            self.midi.stripInputUuids[self.stateData.input.uuid] = self
-            await asyncio.to_thread(self.stateData.render)
-            logging.debug('Loaded input on strip {} - Name: {} | UUID: {}'.format(self.num, self.stateData.input.name, self.stateData.input.uuid))
+            self.stateData.lcdLabel = config.lcdLabel
+            self.midi.bind_input(input, self)
+            if render:
+                await asyncio.to_thread(self.stateData.render)
+            logging.debug('Loaded input on strip {} - Name: {} | Instance: {} | UUID: {}'.format(self.num, input.name, input.instance, input.uuid))
 
-    def reset(self):
+    def reset(self, render: bool = True):
         # reset internal variables
         if self.state == self.State.Active:
-            if self.stateData.input.uuid in self.midi.stripInputUuids:
-                del self.midi.stripInputUuids[self.stateData.input.uuid]
+            self.midi.unbind_input(self.stateData.input)
         self.state = self.State.Idle
         self.stateData = self.StateDataIdle(self.midi, self.num)
         self.oldState = None
+        self.offlineConfig = None
         if self.oldStateData:
             self.oldStateData.midi = None
         self.oldStateData = None
         self.enc_mode = 3
         self.enc_value = -81
 
-        self.stateData.render()
+        if render:
+            self.stateData.render()
 
     def restore(self):
         if not self.oldState:
             return
 
         if self.state == self.State.Active:
-            if self.stateData.input.uuid in self.midi.stripInputUuids:
-                del self.midi.stripInputUuids[self.stateData.input.uuid]
+            self.midi.unbind_input(self.stateData.input)
 
         self.state = self.oldState
         self.oldState = None
@@ -373,7 +767,10 @@ class Strip:
         self.stateData.render()
 
         if self.state == self.State.Active:
-            self.midi.stripInputUuids[self.stateData.input.uuid] = self
+            self.midi.bind_input(self.stateData.input, self)
+
+    def get_input_obs(self) -> obs.ObsStudio:
+        return self.midi.obs.get(self.stateData.input.instance)
 
     async def process_button(self, msg):
         button = msg[0]
@@ -390,7 +787,7 @@ class Strip:
 
                 # update encoder lights
                 final_value = self.enc_value + self.led_modes[self.enc_mode][0]
-                self.midi.output.send_message([176, self.num + 48, final_value])
+                self.midi._send([176, self.num + 48, final_value])
 
             elif self.state == self.State.Config:
                 self.stateData.iterate_menu()
@@ -399,7 +796,7 @@ class Strip:
             if not value or self.state != self.State.Active: # Value will be 127 if pressed down, 0 if released
                 return
             new = not (self.stateData.input.audioTracks.get('2') or False)
-            await self.midi.obs.call('SetInputAudioTracks', {'inputUuid': self.stateData.input.uuid, 'inputAudioTracks': {'2': new}})
+            self.get_input_obs().queue('SetInputAudioTracks', {'inputUuid': self.stateData.input.uuid, 'inputAudioTracks': {'2': new}})
 
         elif button == self.num + 8: # SOLO button
             if not value or self.state != self.State.Active:
@@ -409,13 +806,22 @@ class Strip:
                 new = 'OBS_MONITORING_TYPE_MONITOR_AND_OUTPUT'
             else:
                 new = 'OBS_MONITORING_TYPE_NONE'
-            await self.midi.obs.call('SetInputAudioMonitorType', {'inputUuid': self.stateData.input.uuid, 'monitorType': new})
+            self.get_input_obs().queue('SetInputAudioMonitorType', {'inputUuid': self.stateData.input.uuid, 'monitorType': new})
 
         elif button == self.num + 16: # MUTE button
             if not value or self.state != self.State.Active:
                 return
             new = not self.stateData.input.audioMuted
-            await self.midi.obs.call('SetInputMute', {'inputUuid': self.stateData.input.uuid, 'inputMuted': new})
+            self.get_input_obs().queue('SetInputMute', {'inputUuid': self.stateData.input.uuid, 'inputMuted': new})
+
+        elif button == self.num + 104: # Fader touch
+            if self.state != self.State.Active:
+                return
+            self.stateData.touch_fader(bool(value))
+            if value or self.stateData.faderTime:
+                return # After moves, the fader follows OBS again once the timeout has passed and OBS has confirmed the last one
+            # Changes made in OBS while the fader was held
+            await asyncio.to_thread(self.stateData._render_fader)
 
         elif button == self.num + 24: # SELECT button
             if not value:
@@ -429,6 +835,7 @@ class Strip:
             if self.state == self.State.Config:
                 newInput = self.stateData.inputList[self.stateData.inputIdx][1]
                 lcdColorIdx = self.stateData.lcdColorIdx
+                lcdLabel = self.stateData.lcdLabel
                 if newInput == True or (self.oldState == self.State.Active and self.oldStateData.input == newInput):
                     self.restore()
                     if self.state == self.State.Active:
@@ -438,45 +845,50 @@ class Strip:
                     self.reset()
                 else:
                     for strip in self.midi.strips:
-                        if strip.state == self.State.Active and strip.stateData.input.uuid == newInput.uuid:
+                        if strip.state == self.State.Active and strip.stateData.input.key() == newInput.key():
                             strip.reset()
                     self.oldState = None
                     self.oldStateData = None
+                    self.offlineConfig = None
                     self.state = self.State.Active
                     self.stateData = self.StateDataActive(self.midi, self.num)
                     self.stateData.set_input(newInput)
                     self.stateData.lcdColorIdx = lcdColorIdx
+                    self.stateData.lcdLabel = lcdLabel
                     self.stateData.render()
-                    self.midi.stripInputUuids[newInput.uuid] = self
+                    self.midi.bind_input(newInput, self)
             else:
                 if self.state == self.State.Active:
-                    if self.stateData.input.uuid in self.midi.stripInputUuids:
-                        del self.midi.stripInputUuids[self.stateData.input.uuid]
+                    self.midi.unbind_input(self.stateData.input)
                 self.oldState = self.state
                 self.oldStateData = self.stateData
                 self.oldStateData.midi = None
                 self.state = self.State.Config
                 self.stateData = self.StateDataConfig(self.midi, self.num)
                 self.stateData.lcdColorIdx = self.oldStateData.lcdColorIdx
+                self.stateData.lcdLabel = self.oldStateData.lcdLabel
                 self.stateData.render()
 
         else:
-            logging.info('Unhandled event on strip: {}'.format(self.num))
+            utils.log_sampled('unhandled_{}'.format(self.num), 5.0, logging.INFO, 'Unhandled event on strip: {}', self.num)
 
     async def process_encoder(self, msg):
         if self.state == self.State.Active:
-            logging.info('Encoder value: {}'.format(msg[1]))
+            utils.log_sampled('encoder_value', 0.5, logging.DEBUG, 'Encoder value: {}', msg[1])
             if msg[1] < 50:
                 new = round(self.stateData.input.audioBalance + 0.1, 1)
                 if new > 1.0:
                     new = 1.0
-                await self.midi.obs.call('SetInputAudioBalance', {'inputUuid': self.stateData.input.uuid, 'inputAudioBalance': new})
+                self.get_input_obs().queue('SetInputAudioBalance', {'inputUuid': self.stateData.input.uuid, 'inputAudioBalance': new})
             elif msg[1] > 50:
                 new = round(self.stateData.input.audioBalance - 0.1, 1)
                 if new < 0.0:
                     new = 0.0
-                await self.midi.obs.call('SetInputAudioBalance', {'inputUuid': self.stateData.input.uuid, 'inputAudioBalance': new})
-            logging.info('New: {}'.format(new))
+                self.get_input_obs().queue('SetInputAudioBalance', {'inputUuid': self.stateData.input.uuid, 'inputAudioBalance': new})
+            else:
+                return
+            utils.log_sampled('encoder_new', 0.5, logging.DEBUG, 'New: {}', new)
+            self.stateData.show_readout(utils.format_balance(new))
 
         elif self.state == self.State.Config:
             if msg[1] < 50: # Turn clockwise
@@ -489,17 +901,24 @@ class Strip:
             return
 
         self.stateData.faderTime = time.time_ns()
+        if self.stateData.faderTouched:
+            self.stateData.touch_fader(True)
+        self.midi.on_fader_moved(self.num, msg[1])
 
         db = utils.x32_fader_val_to_db(msg[1])
-        req = simpleobsws.Request('SetInputVolume', {'inputUuid': self.stateData.input.uuid, 'inputVolumeDb': db})
-        await self.midi.obs.ws.emit(req)
+        self.get_input_obs().queue('SetInputVolume', {'inputUuid': self.stateData.input.uuid, 'inputVolumeDb': db}, True)
+        self.stateData.show_readout(utils.format_db(db))
 
     def on_input_volmeter(self, data):
         if self.state != self.State.Active:
             return
 
-        average_mul = [channel[1] for channel in data]
-        average_mul = (sum(average_mul) / len(average_mul)) if average_mul else 0.0
+        total = 0.0
+        count = 0
+        for channel in data:
+            total += channel[1]
+            count += 1
+        average_mul = (total / count) if count else 0.0
 
         if average_mul > 0.0:
             current_peak_db = 20 * math.log10(average_mul)
@@ -0,0 +1,285 @@
+import atexit
+import logging
+import signal
+import struct
+import threading
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+
+import utils
+
+# Runs the rtmidi ports in a separate process, so that MIDI I/O is not held up by the GIL of the main process (websocket parsing,
+# rendering). Messages are exchanged through one shared memory ring buffer per direction. Port management goes through a pipe.
+
+RING_SIZE = 65536
+START_TIMEOUT = 15.0 # The spawned worker imports the main module and rtmidi first
+CALL_TIMEOUT = 5.0
+# Native format, so the counters are packed with one aligned 8-byte store and never read torn by the other process
+RING_HEADER = struct.Struct('QQ') # Total bytes written, total bytes read
+RING_COUNTER = struct.Struct('Q')
+RING_RECORD_LENGTH = struct.Struct('<H')
+
+class RingBuffer:
+    # Single producer, single consumer. Only the producer writes the write counter and only the consumer writes the read counter,
+    # so no lock is needed between the two processes. The producer releases a semaphore per record and the consumer reads one
+    # record per acquire, which also orders the record data before the counter on weakly ordered CPUs.
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self.shm = shm
+        self.buf = shm.buf
+        self.size = len(self.buf) - RING_HEADER.size
+
+    def _copy_in(self, pos: int, data: bytes):
+        start = pos % self.size
+        first = min(len(data), self.size - start)
+        self.buf[RING_HEADER.size + start:RING_HEADER.size + start + first] = data[:first]
+        if first < len(data):
+            self.buf[RING_HEADER.size:RING_HEADER.size + len(data) - first] = data[first:]
+
+    def _copy_out(self, pos: int, length: int) -> bytes:
+        start = pos % self.size
+        first = min(length, self.size - start)
+        ret = bytes(self.buf[RING_HEADER.size + start:RING_HEADER.size + start + first])
+        if first < length:
+            ret += bytes(self.buf[RING_HEADER.size:RING_HEADER.size + length - first])
+        return ret
+
+    def write(self, data: bytes) -> bool:
+        written, read = RING_HEADER.unpack_from(self.buf, 0)
+        needed = RING_RECORD_LENGTH.size + len(data)
+        if self.size - (written - read) < needed:
+            return False
+        self._copy_in(written, RING_RECORD_LENGTH.pack(len(data)))
+        self._copy_in(written + RING_RECORD_LENGTH.size, data)
+        RING_COUNTER.pack_into(self.buf, 0, written + needed) # Publishes the record
+        return True
+
+    def read(self) -> bytes:
+        written, read = RING_HEADER.unpack_from(self.buf, 0)
+        if written == read:
+            return None
+        length = RING_RECORD_LENGTH.unpack(self._copy_out(read, RING_RECORD_LENGTH.size))[0]
+        ret = self._copy_out(read + RING_RECORD_LENGTH.size, length)
+        RING_COUNTER.pack_into(self.buf, RING_COUNTER.size, read + RING_RECORD_LENGTH.size + length)
+        return ret
+
+def _worker_main(conn, inRingName: str, outRingName: str, inSem, outSem, inDropped):
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C reaches the whole process group, the main process stops the worker once the panel is cleared
+    import rtmidi
+    ports = {'in': rtmidi.MidiIn(), 'out': rtmidi.MidiOut()}
+    inShm = shared_memory.SharedMemory(inRingName)
+    outShm = shared_memory.SharedMemory(outRingName)
+    inRing = RingBuffer(inShm)
+    outRing = RingBuffer(outShm)
+    stopping = False
+
+    def on_message(msg, data):
+        if inRing.write(bytes(msg[0])):
+            inSem.release()
+        else:
+            inDropped.value += 1 # Reported by the main process, the worker has no log
+
+    def pump_output():
+        while True:
+            outSem.acquire()
+            data = outRing.read()
+            if data == None and stopping:
+                return # Everything queued before `quit` was sent
+            if data == None or not ports['out'].is_port_open():
+                continue
+            try:
+                ports['out'].send_message(data)
+            except:
+                pass # The device went away, the main process notices through the port list
+    outThread = threading.Thread(target = pump_output, daemon = True)
+    outThread.start()
+
+    while True:
+        cmd, args = conn.recv()
+        try:
+            if cmd == 'quit':
+                stopping = True
+                outSem.release()
+                outThread.join()
+                for port in ports.values():
+                    port.close_port()
+                conn.send(None)
+                break
+            elif cmd == 'get_ports':
+                conn.send(ports[args[0]].get_ports())
+            elif cmd == 'get_port_name':
+                conn.send(ports[args[0]].get_port_name(args[1]))
+            elif cmd == 'open_port':
+                ports[args[0]].open_port(args[1])
+                if args[0] == 'in':
+                    ports['in'].set_callback(on_message)
+                conn.send(None)
+            elif cmd == 'close_port':
+                if args[0] == 'in':
+                    ports['in'].cancel_callback()
+                ports[args[0]].close_port()
+                conn.send(None)
+            elif cmd == 'is_port_open':
+                conn.send(ports[args[0]].is_port_open())
+            else:
+                conn.send(Exception('Unknown command: {}'.format(cmd)))
+        except Exception as e:
+            conn.send(e)
+    inShm.close()
+    outShm.close()
+
+class ProcessMidiPort:
+    def __init__(self, process, direction: str):
+        self.process = process
+        self.direction = direction
+
+    def get_ports(self):
+        return self.process.call('get_ports', self.direction)
+
+    def get_port_name(self, idx: int):
+        return self.process.call('get_port_name', self.direction, idx)
+
+    def open_port(self, idx: int = 0):
+        self.process.call('open_port', self.direction, idx)
+
+    def close_port(self):
+        self.process.call('close_port', self.direction)
+
+    def is_port_open(self):
+        return self.process.call('is_port_open', self.direction)
+
+class ProcessMidiIn(ProcessMidiPort):
+    def __init__(self, process):
+        super().__init__(process, 'in')
+        self.callback = None
+        self.callbackData = None
+
+    def set_callback(self, callback, data = None):
+        self.callback = callback
+        self.callbackData = data
+
+    def cancel_callback(self):
+        self.callback = None
+        self.callbackData = None
+
+class ProcessMidiOut(ProcessMidiPort):
+    def __init__(self, process):
+        super().__init__(process, 'out')
+        self.lock = threading.Lock() # Renders may send from several threads, the ring has a single producer
+
+    def send_message(self, msg):
+        with self.lock:
+            if not self.process.outRing.write(bytes(msg)):
+                utils.log_sampled('midi_out_ring_full', 5.0, logging.ERROR, 'MIDI output ring buffer is full, dropping message.')
+                return
+        self.process.outSem.release()
+
+class MidiProcess:
+    # Owns the worker process. `input` and `output` stand in for `rtmidi.MidiIn`/`rtmidi.MidiOut` in `midi.Device`.
+    def __init__(self):
+        self.context = multiprocessing.get_context('spawn')
+        self.inShm = None
+        self.outShm = None
+        self.inRing = None
+        self.outRing = None
+        self.inSem = self.context.Semaphore(0)
+        self.outSem = self.context.Semaphore(0)
+        self.inDropped = self.context.RawValue('Q', 0) # Incoming messages the worker dropped because the input ring was full, only written by the worker
+        self.inDroppedReported = 0
+        self.conn = None
+        self.connLock = threading.Lock()
+        self.process = None
+        self.readerThread = None
+        self.stopping = False
+
+        self.input = ProcessMidiIn(self)
+        self.output = ProcessMidiOut(self)
+
+    def start(self) -> bool:
+        self.inShm = shared_memory.SharedMemory(create = True, size = RING_HEADER.size + RING_SIZE)
+        self.outShm = shared_memory.SharedMemory(create = True, size = RING_HEADER.size + RING_SIZE)
+        self.inShm.buf[:RING_HEADER.size] = bytes(RING_HEADER.size)
+        self.outShm.buf[:RING_HEADER.size] = bytes(RING_HEADER.size)
+        self.inRing = RingBuffer(self.inShm)
+        self.outRing = RingBuffer(self.outShm)
+
+        self.conn, childConn = self.context.Pipe()
+        self.process = self.context.Process(target = _worker_main, args = (childConn, self.inShm.name, self.outShm.name, self.inSem, self.outSem, self.inDropped), name = 'xtouch-midi-io', daemon = True)
+        self.process.start()
+        childConn.close() # Only the worker holds that end now, so the pipe reports EOF if the worker dies
+        try:
+            self.call('is_port_open', 'in', timeout = START_TIMEOUT) # Wait for the worker to be up
+        except:
+            logging.exception('MIDI I/O process failed to start:\n')
+            self.stop()
+            return False
+
+        self.readerThread = threading.Thread(target = self._read_input, daemon = True)
+        self.readerThread.start()
+        atexit.register(self.stop) # Startup may bail out before the regular shutdown, the shared memory has to be released anyway
+        logging.info('Started MIDI I/O process (pid {}).'.format(self.process.pid))
+        return True
+
+    def stop(self):
+        if self.stopping:
+            return
+        self.stopping = True
+        if self.process and self.process.is_alive():
+            try:
+                self.call('quit')
+            except:
+                pass
+            self.process.join(2)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.inSem.release() # Wakes the reader thread up so that it can exit
+        if self.readerThread:
+            self.readerThread.join()
+        for shm in [self.inShm, self.outShm]:
+            if not shm:
+                continue
+            shm.close()
+            shm.unlink()
+        self.inShm = None
+        self.outShm = None
+
+    def call(self, cmd: str, *args, timeout: float = CALL_TIMEOUT):
+        with self.connLock:
+            if not self.process.is_alive():
+                raise Exception('MIDI I/O process is not running.')
+            try:
+                self.conn.send((cmd, args))
+                startTime = time.monotonic()
+                while not self.conn.poll(0.1):
+                    if not self.process.is_alive():
+                        raise EOFError()
+                    if time.monotonic() - startTime > timeout:
+                        # A late reply would be taken as the answer to the next call, so the worker cannot be used anymore
+                        self.process.terminate()
+                        raise Exception('MIDI I/O process did not answer `{}` within {}s.'.format(cmd, timeout))
+                ret = self.conn.recv()
+            except (EOFError, ConnectionError):
+                self.process.join(1)
+                raise Exception('MIDI I/O process exited (exit code {}).'.format(self.process.exitcode)) from None
+        if isinstance(ret, Exception):
+            raise ret
+        return ret
+
+    def _read_input(self):
+        # Feeds messages from the worker to the input callback, on this thread, like rtmidi's own callback thread would
+        while True:
+            self.inSem.acquire()
+            if self.stopping:
+                return
+            data = self.inRing.read()
+            dropped = self.inDropped.value
+            if dropped != self.inDroppedReported:
+                utils.log_sampled('midi_in_ring_full', 5.0, logging.ERROR, 'MIDI input ring buffer was full, {} incoming messages dropped so far.', dropped)
+                self.inDroppedReported = dropped
+            callback = self.input.callback
+            if data == None or not callback:
+                continue
+            try:
+                callback((list(data), 0.0), self.input.callbackData)
+            except:
+                logging.exception('Exception in MIDI input callback:\n')
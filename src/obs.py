@@ -1,8 +1,15 @@
 import logging
 import bisect
 import asyncio
+import functools
+import json
+import inspect
+import msgpack
+import websockets
 import simpleobsws
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields
+
+import utils
 
 @dataclass
 class Input:
@@ -17,9 +24,19 @@ class Input:
     audioMonitorType: str = ''
     audioTracks: dict[str, bool] = field(default_factory = dict)
 
+    instance: str = '' # Name of the `ObsStudio` the input belongs to. Input UUIDs are only unique within an instance.
+
     @staticmethod
-    def from_obsws_data(data):
-        return Input(data['inputUuid'], data['inputName'], data['inputKind'])
+    def from_obsws_data(data, instance: str = ''):
+        return Input(data['inputUuid'], data['inputName'], data['inputKind'], instance = instance)
+
+    @staticmethod
+    def from_dict(data):
+        # Inverse of `dataclasses.asdict`, ignoring unknown fields
+        return Input(**{k: v for k, v in data.items() if k in INPUT_FIELD_NAMES})
+
+    def key(self) -> tuple[str, str]:
+        return (self.instance, self.uuid)
 
     async def hydrate(self, ws) -> bool:
         requests = [
@@ -41,54 +58,335 @@ class Input:
             self.audioTracks = responses[4].responseData['inputAudioTracks']
         return True
 
+INPUT_FIELD_NAMES = set(x.name for x in fields(Input))
+
+EVENT_SUBSCRIPTION_SCENES = 1 << 2
+EVENT_SUBSCRIPTION_INPUTS = 1 << 3
+EVENT_SUBSCRIPTION_INPUT_VOLUME_METERS = 1 << 16
+
+RECONNECT_DELAY_MIN = 2.0
+RECONNECT_DELAY_MAX = 30.0
+
+WEBSOCKET_SUBPROTOCOL_MSGPACK = 'obswebsocket.msgpack'
+WEBSOCKET_SUBPROTOCOL_JSON = 'obswebsocket.json'
+
+wsLog = logging.getLogger('simpleobsws')
+
+class JsonConnection:
+    # Stands in for the websockets connection when the server only speaks JSON. simpleobsws packs everything it sends with msgpack,
+    # which is re-encoded as JSON text here. Only outgoing requests take this detour, incoming messages are decoded by `ObsWebSocket`.
+    def __init__(self, ws):
+        self.ws = ws
+
+    async def send(self, message):
+        if type(message) == bytes:
+            message = json.dumps(msgpack.unpackb(message))
+        await self.ws.send(message)
+
+    def __getattr__(self, name):
+        return getattr(self.ws, name)
+
+class ObsWebSocket(simpleobsws.WebSocketClient):
+    # Negotiates MessagePack with JSON as fallback, and replaces the receive loop of simpleobsws: messages are decoded once and events
+    # are dispatched to callbacks looked up by event type. simpleobsws formats every received message as indented JSON for its debug
+    # log even when that is disabled, and inspects catch-all callback signatures per event, which dominated the cost of meter events.
+    def __init__(self, url: str, password: str = '', identification_parameters: simpleobsws.IdentificationParameters = None):
+        super().__init__(url = url, password = password, identification_parameters = identification_parameters or simpleobsws.IdentificationParameters())
+        self.useMsgpack = True
+        self.sentEventSubscriptions = None # Sent with the last Identify or Reidentify of this connection
+        self.eventCallbacksByType = {}
+        self.catchAllCallbacks = [] # Pairs of (callback, parameter count)
+
+    async def connect(self):
+        if self.ws and self.ws_open:
+            wsLog.debug('WebSocket session is already open. Returning early.')
+            return False
+        self.answers = {}
+        self.recv_task = None
+        self.identified = False
+        self.hello_message = None
+        self.sentEventSubscriptions = None
+        ws = await websockets.connect(self.url, subprotocols = [WEBSOCKET_SUBPROTOCOL_MSGPACK, WEBSOCKET_SUBPROTOCOL_JSON], additional_headers = self.http_headers, max_size = 2**24)
+        # obs-websocket uses JSON when no subprotocol was agreed on
+        self.useMsgpack = ws.subprotocol == WEBSOCKET_SUBPROTOCOL_MSGPACK
+        self.ws = ws if self.useMsgpack else JsonConnection(ws)
+        self.ws_open = True
+        self.recv_task = asyncio.create_task(self._ws_recv_task())
+        logging.debug('Connected to {} using {}.'.format(self.url, 'MessagePack' if self.useMsgpack else 'JSON'))
+        return True
+
+    async def _send_identify(self, password, identification_parameters):
+        self.sentEventSubscriptions = identification_parameters.eventSubscriptions
+        await super()._send_identify(password, identification_parameters)
+
+    async def send_payload(self, payload: dict):
+        # For messages simpleobsws has no method for
+        if self.useMsgpack:
+            await self.ws.send(msgpack.packb(payload))
+        else:
+            await self.ws.send(json.dumps(payload))
+
+    def register_event_callback(self, callback, event: str = None):
+        super().register_event_callback(callback, event)
+        self._update_event_dispatch()
+
+    def deregister_event_callback(self, callback, event: str = None):
+        super().deregister_event_callback(callback, event)
+        self._update_event_dispatch()
+
+    def _update_event_dispatch(self):
+        eventCallbacksByType = {}
+        catchAllCallbacks = []
+        for callback, trigger in self.event_callbacks:
+            if trigger == None:
+                catchAllCallbacks.append((callback, len(inspect.signature(callback).parameters)))
+            else:
+                eventCallbacksByType.setdefault(trigger, []).append(callback)
+        self.eventCallbacksByType = eventCallbacksByType
+        self.catchAllCallbacks = catchAllCallbacks
+
+    def _dispatch_event(self, data: dict):
+        eventType = data['eventType']
+        eventData = data.get('eventData')
+        for callback in self.eventCallbacksByType.get(eventType, ()):
+            asyncio.create_task(callback(eventData))
+        for callback, params in self.catchAllCallbacks:
+            if params == 1:
+                asyncio.create_task(callback(data))
+            elif params == 2:
+                asyncio.create_task(callback(eventType, eventData))
+            elif params == 3:
+                asyncio.create_task(callback(eventType, data.get('eventIntent'), eventData))
+
+    async def _ws_recv_task(self):
+        while self.ws_open:
+            try:
+                message = await self.ws.recv()
+                if not message:
+                    continue
+                if type(message) == bytes:
+                    payload = msgpack.unpackb(message)
+                else:
+                    payload = json.loads(message)
+                opCode = payload['op']
+                data = payload['d']
+
+                if opCode == 5: # Event
+                    self._dispatch_event(data)
+                    continue
+                if wsLog.isEnabledFor(logging.DEBUG):
+                    wsLog.debug('Received message:\n{}'.format(json.dumps(payload, indent = 2)))
+                if opCode == 7 or opCode == 9: # RequestResponse or RequestBatchResponse
+                    requestId = data['requestId']
+                    if requestId.startswith('emit_'):
+                        continue
+                    waiter = self.waiters.get(requestId)
+                    if not waiter:
+                        wsLog.warning('Discarding request response {} because there is no waiter for it.'.format(requestId))
+                        continue
+                    waiter.response_data = data
+                    waiter.event.set()
+                elif opCode == 0: # Hello
+                    self.hello_message = data
+                    await self._send_identify(self.password, self.identification_parameters)
+                elif opCode == 2: # Identified
+                    self.identified = True
+                    async with self.cond:
+                        self.cond.notify_all()
+                else:
+                    wsLog.warning('Unknown OpCode: {}'.format(opCode))
+            except websockets.exceptions.ConnectionClosed:
+                wsLog.debug('The WebSocket connection was closed. Code: {} | Reason: {}'.format(self.ws.close_code, self.ws.close_reason))
+                break
+            except (ValueError, KeyError, msgpack.UnpackException):
+                continue
+            except Exception: # Not `except:`, cancelling the task on disconnect has to end it
+                # Anything else is specific to this message (e.g. a payload that is not a mapping), the connection is still usable
+                wsLog.exception('Exception handling received message:\n')
+                continue
+        self.ws_open = False
+        self.identified = False
+
 class ObsStudio:
-    def __init__(self, websocketUrl, websocketPassword = None):
-        parameters = simpleobsws.IdentificationParameters()
-        parameters.eventSubscriptions = (1 << 3) | (1 << 16)
-        self.ws = simpleobsws.WebSocketClient(url = websocketUrl, password = websocketPassword, identification_parameters=parameters)
+    def __init__(self, websocketUrl, websocketPassword = None, name: str = '', meters: bool = True, ws = None):
+        self.name = name
+        self.url = websocketUrl
+        self.meters = meters
+
+        # `ws` is for stand-ins of `ObsWebSocket` (replay)
+        if ws:
+            self.ws = ws
+        else:
+            parameters = simpleobsws.IdentificationParameters()
+            parameters.eventSubscriptions = self._get_event_subscriptions()
+            self.ws = ObsWebSocket(websocketUrl, websocketPassword, parameters)
         self.ws.register_event_callback(self._event_on_input_created, 'InputCreated')
         self.ws.register_event_callback(self._event_on_input_removed, 'InputRemoved')
         self.ws.register_event_callback(self._event_on_input_name_changed, 'InputNameChanged')
+        self.ws.register_event_callback(self._event_on_input_volume_changed, 'InputVolumeChanged')
+        self.ws.register_event_callback(self._event_on_input_mute_changed, 'InputMuteStateChanged')
+        self.ws.register_event_callback(self._event_on_input_balance_changed, 'InputAudioBalanceChanged')
+        self.ws.register_event_callback(self._event_on_input_monitor_changed, 'InputAudioMonitorTypeChanged')
+        self.ws.register_event_callback(self._event_on_input_tracks_changed, 'InputAudioTracksChanged')
 
         self.inputsLock = asyncio.Lock()
         self.inputs = {}
         self.inputNames = []
+        self.stateGeneration = 0 # Incremented on every change to cached input state
+        self.offline = False # Failed to connect or lost the connection, `ObsPool` keeps retrying
+
+        self.requestCallback = None # Called with (instance name, requestType, requestData) for every outgoing request
+
+        # Requests queued with `queue`, sent as one batch per loop tick
+        self.pendingRequests = []
+        self.pendingCoalesced = {}
+        self.flushScheduled = False
+        self.flushLock = asyncio.Lock()
 
     async def startup(self) -> bool:
         if not await self.ws.connect():
             return False
         if not await self.ws.wait_until_identified():
             return False
+        # Meters may have been switched after Identify went out
+        await self._update_event_subscriptions()
         await self._refresh_input_list()
         return True
 
     async def shutdown(self):
+        await self._flush()
         await self.ws.disconnect()
         self.ws = None
 
+    async def wait_until_disconnected(self):
+        # Not awaited directly, cancelling the caller must not cancel the receive task
+        await asyncio.wait([self.ws.recv_task])
+
+    async def set_offline(self):
+        # Drops what is left of the connection and the inputs, which can't be controlled until `startup` succeeds again
+        self.offline = True
+        try:
+            await self.ws.disconnect()
+        except:
+            pass
+        self.pendingRequests = []
+        self.pendingCoalesced = {}
+        async with self.inputsLock:
+            self.inputs = {}
+            self.inputNames = []
+            self.stateGeneration += 1
+
     async def call(self, requestType, requestData = None) -> dict:
+        if self.requestCallback:
+            self.requestCallback(self.name, requestType, requestData)
         req = simpleobsws.Request(requestType, requestData)
         resp = await self.ws.call(req)
         if not resp.ok():
-            raise Exception('`{}` request returned invalid status: {} | Comment: {}'.format(ret.requestStatus.code, ret.requestStatus.comment))
+            raise Exception('`{}` request returned invalid status: {} | Comment: {}'.format(requestType, resp.requestStatus.code, resp.requestStatus.comment))
         return resp.responseData
 
+    def queue(self, requestType, requestData = None, coalesce: bool = False):
+        # Fire and forget. Everything queued within one loop tick is sent as a single serial batch, batches are sent one at a time so
+        # requests execute in the order they were queued. With `coalesce`, a still pending request of the same type for the same
+        # input is updated in place instead of queueing another one (e.g. fader moves).
+        if self.requestCallback:
+            self.requestCallback(self.name, requestType, requestData)
+        if coalesce:
+            key = (requestType, requestData.get('inputUuid'))
+            request = self.pendingCoalesced.get(key)
+            if request:
+                request.requestData = requestData
+                return
+        request = simpleobsws.Request(requestType, requestData)
+        self.pendingRequests.append(request)
+        if coalesce:
+            self.pendingCoalesced[key] = request
+        if not self.flushScheduled:
+            self.flushScheduled = True
+            asyncio.get_running_loop().call_soon(self._schedule_flush)
+
+    def _schedule_flush(self):
+        self.flushScheduled = False
+        asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        async with self.flushLock:
+            # Requests queued while the previous batch was in flight go out together
+            if not self.pendingRequests or not self.ws:
+                return
+            requests = self.pendingRequests
+            self.pendingRequests = []
+            self.pendingCoalesced = {}
+            try:
+                responses = await self.ws.call_batch(requests, halt_on_failure = False, execution_type = simpleobsws.RequestBatchExecutionType.SerialRealtime)
+            except:
+                logging.exception('Failed to send batch of {} requests to OBS instance `{}`:\n'.format(len(requests), self.name))
+                return
+            for request, response in zip(requests, responses):
+                if not response.ok():
+                    logging.error('`{}` request to OBS instance `{}` returned invalid status: {} | Comment: {}'.format(request.requestType, self.name, response.requestStatus.code, response.requestStatus.comment))
+
+    async def set_meters_enabled(self, enabled: bool):
+        if enabled == self.meters or not self.ws: # `ws` is gone after shutdown
+            return
+        self.meters = enabled
+        self.ws.identification_parameters.eventSubscriptions = self._get_event_subscriptions()
+        if not self.ws.is_identified():
+            return # Sent with the next Identify, or by `startup` once identified if Identify already went out
+        await self._update_event_subscriptions()
+
+    async def _update_event_subscriptions(self):
+        subscriptions = self._get_event_subscriptions()
+        if subscriptions == self.ws.sentEventSubscriptions:
+            return
+        # simpleobsws has no Reidentify support, so send it ourselves
+        try:
+            await self.ws.send_payload({'op': 3, 'd': {'eventSubscriptions': subscriptions}})
+        except:
+            logging.exception('Failed to re-identify with OBS instance `{}`:\n'.format(self.name))
+            return
+        self.ws.sentEventSubscriptions = subscriptions
+        logging.debug('Re-identified with OBS instance `{}`. Meters enabled: {}'.format(self.name, self.meters))
+
+    def _get_event_subscriptions(self) -> int:
+        ret = EVENT_SUBSCRIPTION_SCENES | EVENT_SUBSCRIPTION_INPUTS
+        if self.meters:
+            ret |= EVENT_SUBSCRIPTION_INPUT_VOLUME_METERS
+        return ret
+
+    def set_cached_inputs(self, inputsData: list[dict]):
+        # Populates the inputs from a snapshot (`obs.Input` fields), until `startup` replaces them with live ones
+        self.inputs = {}
+        self.inputNames = []
+        for inputData in inputsData:
+            if inputData.get('instance', '') != self.name:
+                continue
+            input = Input.from_dict(inputData)
+            self.inputs[input.uuid] = input
+            self.inputNames.append([input.name, input])
+        self.inputNames.sort(key = lambda x: x[0].lower())
+        self.stateGeneration += 1
+
     async def _refresh_input_list(self):
         resp = await self.call('GetInputList')
+        inputs = [Input.from_obsws_data(inputData, self.name) for inputData in resp['inputs']]
+        # Hydrate all inputs concurrently rather than one round trip at a time
+        await asyncio.gather(*[input.hydrate(self.ws) for input in inputs])
         async with self.inputsLock:
             self.inputs = {}
-            for inputData in resp['inputs']:
-                input = Input.from_obsws_data(inputData)
-                await input.hydrate(self.ws)
+            self.inputNames = []
+            for input in inputs:
                 self.inputs[input.uuid] = input
                 self.inputNames.insert(bisect.bisect_left([x[0].lower() for x in self.inputNames], input.name.lower()), [input.name, input])
+            self.stateGeneration += 1
 
     async def _event_on_input_created(self, eventData):
-        input = Input.from_obsws_data(eventData)
+        input = Input.from_obsws_data(eventData, self.name)
         async with self.inputsLock:
             await input.hydrate(self.ws)
             self.inputs[input.uuid] = input
             self.inputNames.insert(bisect.bisect_left([x[0].lower() for x in self.inputNames], input.name.lower()), [input.name, input])
+            self.stateGeneration += 1
 
     async def _event_on_input_removed(self, eventData):
         inputUuid = eventData['inputUuid']
@@ -97,6 +395,7 @@ class ObsStudio:
                 return
             del self.inputs[inputUuid]
             self.inputNames = [x for x in self.inputNames if x[1].uuid != inputUuid]
+            self.stateGeneration += 1
 
     async def _event_on_input_name_changed(self, eventData):
         inputUuid = eventData['inputUuid']
@@ -108,3 +407,159 @@ class ObsStudio:
             input = self.inputs[inputUuid]
             input.name = eventData['inputName']
             self.inputNames.insert(bisect.bisect_left([x[0].lower() for x in self.inputNames], input.name.lower()), [input.name, input])
+            self.stateGeneration += 1
+
+    # Input state is kept up to date for all inputs, not just the ones bound to strips, so that any layout can be rendered from it
+    def _update_input(self, eventData, name: str, value):
+        input = self.inputs.get(eventData['inputUuid'])
+        if not input:
+            return
+        setattr(input, name, value)
+        self.stateGeneration += 1
+
+    async def _event_on_input_volume_changed(self, eventData):
+        self._update_input(eventData, 'audioVolumeDb', eventData['inputVolumeDb'])
+
+    async def _event_on_input_mute_changed(self, eventData):
+        self._update_input(eventData, 'audioMuted', eventData['inputMuted'])
+
+    async def _event_on_input_balance_changed(self, eventData):
+        self._update_input(eventData, 'audioBalance', eventData['inputAudioBalance'])
+
+    async def _event_on_input_monitor_changed(self, eventData):
+        self._update_input(eventData, 'audioMonitorType', eventData['monitorType'])
+
+    async def _event_on_input_tracks_changed(self, eventData):
+        self._update_input(eventData, 'audioTracks', eventData['inputAudioTracks'])
+
+class ObsPool:
+    # The set of OBS instances strips can be bound to, keyed by instance name. The primary instance is named ''.
+    def __init__(self):
+        self.instances = {}
+        self.loop = None
+        self.meterInstanceNames = set()
+        self.meterUpdateScheduled = False
+        self.connectionCallback = None # Called with (instance name, connected) when an instance goes offline or comes back
+        self.connectionTasks = []
+
+    def add(self, obs: ObsStudio):
+        self.instances[obs.name] = obs
+
+    def get(self, name: str) -> ObsStudio:
+        return self.instances.get(name)
+
+    async def startup(self) -> bool:
+        self.loop = asyncio.get_running_loop()
+        names = list(self.instances.keys())
+        results = await asyncio.gather(*[self.instances[name].startup() for name in names], return_exceptions = True)
+        for name, result in zip(names, results):
+            if result == True:
+                logging.info('Connected and identified with OBS instance `{}` at URL: {}'.format(name, self.instances[name].url))
+                continue
+            if isinstance(result, BaseException):
+                logging.error('Failed to connect or identify with OBS instance `{}`: {}'.format(name, result))
+            else:
+                logging.error('Failed to connect or identify with OBS instance `{}`.'.format(name))
+            if name == '':
+                return False
+            # Secondary instances are optional, a backup encoder being offline should not prevent startup. It is retried in the background.
+            await self.instances[name].set_offline()
+        for obs in self.instances.values():
+            self.connectionTasks.append(asyncio.create_task(self._keep_connected(obs)))
+        return True
+
+    async def shutdown(self):
+        for task in self.connectionTasks:
+            task.cancel()
+        self.connectionTasks = []
+        await asyncio.gather(*[obs.shutdown() for obs in self.instances.values()], return_exceptions = True)
+
+    def set_connection_callback(self, callback):
+        self.connectionCallback = callback
+
+    async def _keep_connected(self, obs: ObsStudio):
+        # Reconnects an instance whenever it is offline, waiting longer after every failed attempt
+        delay = RECONNECT_DELAY_MIN
+        while True:
+            if not obs.offline:
+                await obs.wait_until_disconnected()
+                logging.error('Lost the connection to OBS instance `{}`. Reconnecting...'.format(obs.name))
+                await obs.set_offline()
+                await self._notify_connection(obs.name, False)
+            await asyncio.sleep(delay)
+            try:
+                connected = await obs.startup()
+            except Exception as e:
+                utils.log_sampled('obs_reconnect_{}'.format(obs.name), 60.0, logging.WARNING, 'Failed to reconnect to OBS instance `{}`: {}', obs.name, e)
+                connected = False
+            if not connected:
+                await obs.set_offline()
+                delay = min(delay * 2, RECONNECT_DELAY_MAX)
+                continue
+            delay = RECONNECT_DELAY_MIN
+            obs.offline = False
+            logging.info('Reconnected to OBS instance `{}` at URL: {}'.format(obs.name, obs.url))
+            await self._notify_connection(obs.name, True)
+
+    async def _notify_connection(self, name: str, connected: bool):
+        if not self.connectionCallback:
+            return
+        try:
+            await self.connectionCallback(name, connected)
+        except:
+            logging.exception('Exception in OBS connection callback:\n')
+
+    async def flush(self):
+        # Sends whatever is queued right away instead of on the next loop tick
+        await asyncio.gather(*[obs._flush() for obs in self.instances.values()])
+
+    def register_event_callback(self, callback, event: str = None):
+        # The callback receives the instance name as its first argument
+        for name, obs in self.instances.items():
+            obs.ws.register_event_callback(functools.partial(callback, name), event)
+
+    def set_request_callback(self, callback):
+        for obs in self.instances.values():
+            obs.requestCallback = callback
+
+    def get_inputs(self) -> list[Input]:
+        ret = []
+        for obs in self.instances.values():
+            ret.extend(obs.inputs.values())
+        return ret
+
+    def get_input(self, instance: str, uuid: str) -> Input:
+        obs = self.instances.get(instance)
+        if not obs:
+            return None
+        return obs.inputs.get(uuid)
+
+    def set_cached_inputs(self, inputsData: list[dict]):
+        for obs in self.instances.values():
+            obs.set_cached_inputs(inputsData)
+
+    def get_state_generation(self) -> int:
+        return sum(obs.stateGeneration for obs in self.instances.values())
+
+    def get_input_names(self) -> list:
+        # Pairs of [display name, input]. Inputs of secondary instances are prefixed with the instance name.
+        ret = []
+        for name, obs in self.instances.items():
+            for pair in obs.inputNames:
+                ret.append([pair[0] if not name else '{}:{}'.format(name, pair[0]), pair[1]])
+        return ret
+
+    def update_meter_subscriptions(self, instanceNames: set):
+        # May be called from executor threads. Binding changes made in a row (e.g. loading a layout) are applied once, with the latest set.
+        if not self.loop:
+            return
+        self.meterInstanceNames = set(instanceNames)
+        if self.meterUpdateScheduled:
+            return
+        self.meterUpdateScheduled = True
+        self.loop.call_soon_threadsafe(self._schedule_meter_subscriptions)
+
+    def _schedule_meter_subscriptions(self):
+        self.meterUpdateScheduled = False
+        for name, obs in self.instances.items():
+            self.loop.create_task(obs.set_meters_enabled(name in self.meterInstanceNames))
@@ -0,0 +1,270 @@
+import logging
+import asyncio
+import queue
+import struct
+import threading
+import time
+import dataclasses
+import msgpack
+import simpleobsws
+
+import obs
+import utils
+import emulator
+
+# File layout: TRACE_MAGIC, followed by records. Each record is a RECORD_HEADER (nanoseconds since recording start, record kind, payload length) followed by the payload.
+TRACE_MAGIC = b'XTTRACE1'
+RECORD_HEADER = struct.Struct('<QBI')
+
+RECORD_MIDI_IN = 0 # Raw MIDI bytes received from the device
+RECORD_MIDI_OUT = 1 # Raw MIDI bytes sent to the device
+RECORD_OBS_EVENT = 2 # msgpack [instance, eventType, eventData]
+RECORD_OBS_REQUEST = 3 # msgpack [instance, requestType, requestData]
+RECORD_OBS_INPUTS = 4 # msgpack list of `obs.Input` fields, snapshot of the state of all OBS instances at recording start
+RECORD_CONFIG = 5 # msgpack `utils.Config` dict without OBS instance credentials, strip assignments at recording start
+
+RECORD_KIND_NAMES = {
+    RECORD_MIDI_IN: 'midi_in',
+    RECORD_MIDI_OUT: 'midi_out',
+    RECORD_OBS_EVENT: 'obs_event',
+    RECORD_OBS_REQUEST: 'obs_request',
+    RECORD_OBS_INPUTS: 'obs_inputs',
+    RECORD_CONFIG: 'config'
+}
+
+class Recorder:
+    # Like `utils.setup_logging`, callers only enqueue records and the file is written by a writer thread
+    def __init__(self, fileName: str):
+        self.fileName = fileName
+        self.file = None
+        self.queue = queue.SimpleQueue()
+        self.writerThread = None
+        self.recording = False
+        self.startTime = 0
+        self.recordCount = 0
+
+    def start(self) -> bool:
+        try:
+            self.file = open(self.fileName, 'wb')
+            self.file.write(TRACE_MAGIC)
+        except:
+            logging.exception('Exception opening trace file `{}`:\n'.format(self.fileName))
+            self.file = None
+            return False
+        self.startTime = time.monotonic_ns()
+        self.recordCount = 0
+        self.recording = True
+        self.writerThread = threading.Thread(target = self._write_records, daemon = True)
+        self.writerThread.start()
+        return True
+
+    def stop(self):
+        if not self.recording:
+            return
+        self.recording = False
+        self.queue.put(None)
+        self.writerThread.join()
+        self.file.close()
+        self.file = None
+        logging.info('Wrote {} records to trace file `{}`.'.format(self.recordCount, self.fileName))
+
+    def record(self, kind: int, payload: bytes):
+        # Called from the rtmidi thread, executor threads and the event loop
+        if not self.recording:
+            return
+        self.queue.put((time.monotonic_ns() - self.startTime, kind, payload))
+
+    def _write_records(self):
+        while True:
+            record = self.queue.get()
+            if record == None:
+                return
+            timestamp, kind, payload = record
+            try:
+                self.file.write(RECORD_HEADER.pack(timestamp, kind, len(payload)))
+                self.file.write(payload)
+            except:
+                utils.log_sampled('trace_write_error', 5.0, logging.ERROR, 'Failed to write to trace file `{}`.', self.fileName)
+                continue
+            self.recordCount += 1
+
+    def record_midi_in(self, msg):
+        self.record(RECORD_MIDI_IN, bytes(msg))
+
+    def record_midi_out(self, msg):
+        self.record(RECORD_MIDI_OUT, bytes(msg))
+
+    def record_obs_event(self, instance: str, eventType: str, eventData: dict):
+        self.record(RECORD_OBS_EVENT, msgpack.packb([instance, eventType, eventData]))
+
+    def record_obs_request(self, instance: str, requestType: str, requestData: dict):
+        self.record(RECORD_OBS_REQUEST, msgpack.packb([instance, requestType, requestData]))
+
+    def record_obs_inputs(self, inputs: list[obs.Input]):
+        self.record(RECORD_OBS_INPUTS, msgpack.packb([dataclasses.asdict(input) for input in inputs]))
+
+    def record_config(self, config: utils.Config):
+        data = config.to_dict()
+        del data['obs_instances']
+        self.record(RECORD_CONFIG, msgpack.packb(data))
+
+    async def on_obs_event(self, instance, eventType, eventData):
+        self.record_obs_event(instance, eventType, eventData)
+
+def read_records(fileName: str):
+    with open(fileName, 'rb') as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise Exception('`{}` is not a trace file.'.format(fileName))
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            timestamp, kind, length = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                logging.warning('Trace file `{}` is truncated.'.format(fileName))
+                break
+            yield timestamp, kind, payload
+
+class RecordingMidiOut:
+    # Wraps an output port, recording every message sent through it
+    def __init__(self, output, recorder: Recorder):
+        self.output = output
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.output, name)
+
+    def send_message(self, msg):
+        self.recorder.record_midi_out(msg)
+        self.output.send_message(msg)
+
+class StubWebSocket:
+    # Stands in for `simpleobsws.WebSocketClient`. Requests are counted and acknowledged, events are delivered by `dispatch`.
+    def __init__(self):
+        self.event_callbacks = []
+        self.requestCount = 0
+        self.responses = {} # Request type -> response data returned by `call`, e.g. state taken from the trace
+
+    def register_event_callback(self, callback, event: str = None):
+        self.event_callbacks.append((callback, event))
+
+    def deregister_event_callback(self, callback, event: str = None):
+        self.event_callbacks = [x for x in self.event_callbacks if not (x[0] == callback and (event == None or x[1] == event))]
+
+    async def connect(self):
+        return True
+
+    async def wait_until_identified(self, timeout: int = 10):
+        return True
+
+    async def disconnect(self):
+        return True
+
+    def _build_response(self, request: simpleobsws.Request, result: bool) -> simpleobsws.RequestResponse:
+        self.requestCount += 1
+        ret = simpleobsws.RequestResponse(request.requestType, responseData = self.responses.get(request.requestType, {}) if result else None)
+        ret.requestStatus.result = result
+        ret.requestStatus.code = 100 if result else 600
+        return ret
+
+    async def call(self, request: simpleobsws.Request, timeout: int = 15):
+        return self._build_response(request, True)
+
+    async def emit(self, request: simpleobsws.Request):
+        self._build_response(request, True)
+
+    async def call_batch(self, requests: list, timeout: int = 15, halt_on_failure: bool = None, execution_type = None, variables: dict = None):
+        # The stub has no input state to query, so newly created inputs hydrate as non-audio
+        return [self._build_response(request, not request.requestType.startswith('Get')) for request in requests]
+
+    async def emit_batch(self, requests: list, halt_on_failure: bool = None, execution_type = None, variables: dict = None):
+        for request in requests:
+            self._build_response(request, True)
+
+    async def dispatch(self, eventType: str, eventData: dict):
+        # Awaited in order (unlike simpleobsws, which spawns a task per callback) to keep replays deterministic
+        for callback, trigger in self.event_callbacks:
+            if trigger == eventType:
+                await callback(eventData)
+            elif trigger == None:
+                await callback(eventType, eventData)
+
+class StubObsStudio(obs.ObsStudio):
+    def __init__(self, name: str = ''):
+        super().__init__('replay', name = name, ws = StubWebSocket())
+
+    async def startup(self) -> bool:
+        return True
+
+    async def wait_until_disconnected(self):
+        await asyncio.Event().wait() # Never disconnects
+
+    async def set_meters_enabled(self, enabled: bool):
+        self.meters = enabled
+
+class Player:
+    def __init__(self, fileName: str, speed: float = 1.0):
+        self.fileName = fileName
+        self.speed = speed # 0 replays as fast as possible
+        self.records = []
+        self.inputsData = []
+        self.config = utils.Config()
+        self.recordedCounts = {}
+        self.instanceNames = set([''])
+
+    def load(self) -> bool:
+        try:
+            self.records = list(read_records(self.fileName))
+        except:
+            logging.exception('Exception loading trace file `{}`:\n'.format(self.fileName))
+            return False
+        self.recordedCounts = {}
+        configLoaded = False
+        for timestamp, kind, payload in self.records:
+            self.recordedCounts[kind] = self.recordedCounts.get(kind, 0) + 1
+            # Only the first snapshot is used, later ones would belong to a reconnect
+            if kind == RECORD_OBS_INPUTS and not self.inputsData:
+                self.inputsData = msgpack.unpackb(payload)
+            elif kind == RECORD_CONFIG and not configLoaded:
+                self.config.from_dict(msgpack.unpackb(payload))
+                configLoaded = True
+            elif kind == RECORD_OBS_EVENT:
+                self.instanceNames.add(msgpack.unpackb(payload)[0])
+        logging.info('Loaded {} records from trace file `{}`.'.format(len(self.records), self.fileName))
+        return True
+
+    def add_stub_instances(self, pool: obs.ObsPool):
+        instanceNames = self.instanceNames | set(x.get('instance', '') for x in self.inputsData)
+        for name in sorted(instanceNames):
+            stub = StubObsStudio(name)
+            stub.set_cached_inputs(self.inputsData)
+            if name == '':
+                stub.ws.responses['GetCurrentProgramScene'] = {'currentProgramSceneName': self.config.lastScene}
+            pool.add(stub)
+
+    async def play(self, midiIn: emulator.VirtualMidiIn, pool: obs.ObsPool):
+        startTime = time.monotonic_ns()
+        for timestamp, kind, payload in self.records:
+            if self.speed > 0:
+                delay = (timestamp / self.speed) - (time.monotonic_ns() - startTime)
+                if delay > 0:
+                    await asyncio.sleep(delay / 1000000000)
+            if kind == RECORD_MIDI_IN:
+                # The input callback hands the message to the event loop, wait for its handler to finish
+                future = midiIn.inject(payload)
+                if future:
+                    await asyncio.wrap_future(future)
+            elif kind == RECORD_OBS_EVENT:
+                instance, eventType, eventData = msgpack.unpackb(payload)
+                await pool.get(instance).ws.dispatch(eventType, eventData)
+            # Requests queued by the handlers go out before the next record is fed in, so every replay sends the same batches
+            await pool.flush()
+        logging.info('Replay finished in {:.3f}s.'.format((time.monotonic_ns() - startTime) / 1000000000))
+
+    def log_summary(self, surface: emulator.VirtualSurface, pool: obs.ObsPool):
+        for kind, count in sorted(self.recordedCounts.items()):
+            logging.info('  - Recorded {}: {}'.format(RECORD_KIND_NAMES.get(kind, kind), count))
+        logging.info('  - Replayed obs_request: {}'.format(sum(stub.ws.requestCount for stub in pool.instances.values())))
+        logging.info('Replayed MIDI output:')
+        surface.log_stats()
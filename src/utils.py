@@ -1,4 +1,9 @@
 import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
 import json
 from dataclasses import dataclass, field
 
@@ -31,50 +36,169 @@ def x32_db_to_fader_val(db: float) -> int:
     deflection = ((val - X32_FADER_RANGE_HALF) / X32_FADER_SCALE) + X32_FADER_RANGE_HALF
     return int(deflection) if deflection > 0.0 else 0
 
+def format_db(db: float) -> str:
+    # Fits the 7 characters of an LCD line
+    if db <= -100.0:
+        return '-inf dB'
+    return '{:+.1f}dB'.format(db)
+
+def format_balance(balance: float) -> str:
+    pct = round((balance - 0.5) * 200)
+    if pct == 0:
+        return 'C'
+    return '{}{}'.format('L' if pct < 0 else 'R', abs(pct))
+
+_logSamples = {}
+_logSamplesLock = threading.Lock() # Hot paths log from rtmidi callback threads, executor threads and the event loop
+
+def setup_logging(level: int, fileName: str) -> logging.handlers.QueueListener:
+    # Callers (rtmidi callback thread, executor threads, the event loop) only enqueue records. The file is written by the listener thread.
+    logQueue = queue.SimpleQueue()
+    fileHandler = logging.FileHandler(fileName)
+    fileHandler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    listener = logging.handlers.QueueListener(logQueue, fileHandler, respect_handler_level = True)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(logQueue))
+    root.setLevel(level)
+
+    listener.start()
+    return listener
+
+def log_sampled(key: str, interval: float, level: int, msg: str, *args):
+    # Rate limited logging for hot paths. Emits at most one message per `interval` seconds for each `key`, and reports how many were dropped in between.
+    # `msg` is only formatted (with `str.format`) when the message is actually emitted.
+    if not logging.getLogger().isEnabledFor(level):
+        return
+    now = time.monotonic()
+    with _logSamplesLock:
+        sample = _logSamples.get(key)
+        if sample and now - sample[0] < interval:
+            sample[1] += 1
+            return
+        _logSamples[key] = [now, 0]
+    if args:
+        msg = msg.format(*args)
+    if sample and sample[1]:
+        msg = '{} ({} similar messages suppressed)'.format(msg, sample[1])
+    logging.log(level, msg)
+
 @dataclass
 class StripConfig:
     obsInputUuid: str = ''
+    obsInstance: str = '' # Name of the OBS instance `obsInputUuid` belongs to. '' is the primary instance.
     lcdColorIdx: int = 7
+    lcdLabel: str = '' # Bottom LCD line, when no live value is shown
 
     def to_dict(self):
         return {
             'obs_input_uuid': self.obsInputUuid,
-            'lcd_color_idx': self.lcdColorIdx
+            'obs_instance': self.obsInstance,
+            'lcd_color_idx': self.lcdColorIdx,
+            'lcd_label': self.lcdLabel
         }
 
     @staticmethod
     def from_dict(data):
         ret = StripConfig()
         ret.obsInputUuid = data.get('obs_input_uuid') or ret.obsInputUuid
+        ret.obsInstance = data.get('obs_instance') or ret.obsInstance
         ret.lcdColorIdx = data.get('lcd_color_idx') or ret.lcdColorIdx
+        ret.lcdLabel = data.get('lcd_label') or ret.lcdLabel
+        return ret
+
+@dataclass
+class ObsInstanceConfig:
+    name: str = ''
+    url: str = ''
+    password: str = ''
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'url': self.url,
+            'password': self.password
+        }
+
+    @staticmethod
+    def from_dict(data):
+        ret = ObsInstanceConfig()
+        ret.name = data.get('name') or ret.name
+        ret.url = data.get('url') or ret.url
+        ret.password = data.get('password') or ret.password
         return ret
 
 @dataclass
 class Config:
     strips: list[StripConfig] = field(default_factory = list)
+    obsInstances: list[ObsInstanceConfig] = field(default_factory = list) # Secondary OBS instances. The primary one is set via the command line.
+    sceneLayouts: dict[str, list[StripConfig]] = field(default_factory = dict) # Strip layouts used instead of `strips` while the primary instance's program scene has the given name
+    lastScene: str = '' # Layout in use when the config was last saved
+    inputSnapshot: list[dict] = field(default_factory = list) # Last known `obs.Input` fields of every input used by a layout
 
     def load(self, fileName: str) -> bool:
         try:
             with open(fileName, 'r') as f:
-                config = json.load(f)
-
-                strips = config.get('strips')
-                if type(strips) == list:
-                    for strip in strips:
-                        self.strips.append(StripConfig.from_dict(strip) if type(strip) == dict else StripConfig())
+                self.from_dict(json.load(f))
         except:
             logging.exception('Exception loading config file `{}`:\n'.format(fileName))
             return False
         return True
 
     def save(self, fileName: str) -> bool:
+        # Written to a temporary file first, so that a crash while saving does not leave a truncated config behind
         try:
-            data = {
-                'strips': [strip.to_dict() for strip in self.strips]
-            }
-            with open(fileName, 'w') as f:
-                json.dump(data, f, indent = 2)
+            with open(fileName + '.tmp', 'w') as f:
+                json.dump(self.to_dict(), f, indent = 2)
+            os.replace(fileName + '.tmp', fileName)
         except:
             logging.exception('Exception writing config file `{}`:\n'.format(fileName))
             return False
         return True
+
+    def to_dict(self):
+        return {
+            'strips': [strip.to_dict() for strip in self.strips],
+            'obs_instances': [obsInstance.to_dict() for obsInstance in self.obsInstances],
+            'scene_layouts': {sceneName: [strip.to_dict() for strip in strips] for sceneName, strips in self.sceneLayouts.items()},
+            'last_scene': self.lastScene,
+            'input_snapshot': self.inputSnapshot
+        }
+
+    def from_dict(self, config):
+        strips = config.get('strips')
+        if type(strips) == list:
+            for strip in strips:
+                self.strips.append(StripConfig.from_dict(strip) if type(strip) == dict else StripConfig())
+
+        sceneLayouts = config.get('scene_layouts')
+        if type(sceneLayouts) == dict:
+            for sceneName, strips in sceneLayouts.items():
+                if type(strips) != list:
+                    continue
+                self.sceneLayouts[sceneName] = [StripConfig.from_dict(strip) if type(strip) == dict else StripConfig() for strip in strips]
+
+        obsInstances = config.get('obs_instances')
+        if type(obsInstances) == list:
+            for obsInstance in obsInstances:
+                if type(obsInstance) != dict:
+                    continue
+                obsInstance = ObsInstanceConfig.from_dict(obsInstance)
+                if not obsInstance.name or not obsInstance.url:
+                    logging.warning('Ignoring OBS instance without name or URL.')
+                    continue
+                self.obsInstances.append(obsInstance)
+
+        self.lastScene = config.get('last_scene') or self.lastScene
+
+        inputSnapshot = config.get('input_snapshot')
+        if type(inputSnapshot) == list:
+            self.inputSnapshot = [x for x in inputSnapshot if type(x) == dict and x.get('uuid')]
+
+    def get_all_strips(self) -> list[StripConfig]:
+        ret = list(self.strips)
+        for strips in self.sceneLayouts.values():
+            ret.extend(strips)
+        return ret